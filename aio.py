@@ -0,0 +1,276 @@
+import asyncio
+import struct
+from collections import deque
+from inspect import isawaitable
+
+import Pyro4
+from Pyro4 import constants, errors, message, util
+from Pyro4.message import Message
+
+import metrics
+
+
+# Pyro4's wire protocol on asyncio streams, so that an event loop can
+# serve Pyro4 objects and call them without a thread per connection.
+# Pyro4 proxies and daemons on the other end don't see the difference.
+
+
+async def read_message(reader):
+    try:
+        msg = Message.from_header(await reader.readexactly(Message.header_size))
+        if msg.annotations_size:
+            msg.annotations = parse_annotations(await reader.readexactly(msg.annotations_size))
+        msg.data = await reader.readexactly(msg.data_size)
+    except (asyncio.IncompleteReadError, ConnectionError) as exc:
+        raise errors.ConnectionClosedError("connection lost") from exc
+    return msg
+
+
+def parse_annotations(data):
+    # like Message.recv; we don't check hmacs
+    annotations, i = {}, 0
+    while i < len(data):
+        key, length = struct.unpack("!4sH", data[i:i + 6])
+        annotations[key.decode("ascii")] = data[i + 6:i + 6 + length]
+        i += 6 + length
+    return annotations
+
+
+def exception_reply(serializer, seq, exc, annotations=None):
+    exc._pyroTraceback = util.formatTraceback()
+    try:
+        data, _ = serializer.serializeData(exc)
+    except Exception:
+        data, _ = serializer.serializeData(errors.PyroError("%s: %s" % (type(exc).__name__, exc)))
+    return Message(message.MSG_RESULT, data, serializer.serializer_id,
+                   message.FLAGS_EXCEPTION, seq, annotations)
+
+
+class Daemon:
+    # serves objects like a Pyro4.Daemon, but on the event loop: one task
+    # per connection, handling its calls in order. exposed methods may be
+    # coroutines, which don't hold up the other connections while they wait.
+    def __init__(self, host=None, port=0):
+        self.host = host or Pyro4.config.HOST
+        self.port = port
+        self.objects = {}
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.serve, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    def register(self, obj, objectId):
+        self.objects[objectId] = obj
+        return Pyro4.URI("PYRO:%s@%s:%d" % (objectId, self.host, self.port))
+
+    async def serve(self, reader, writer):
+        try:
+            if await self.handshake(reader, writer):
+                while True:
+                    reply = await self.handle(await read_message(reader))
+                    if reply is not None:
+                        writer.write(reply.to_bytes())
+                        await writer.drain()
+        except (errors.CommunicationError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def handshake(self, reader, writer):
+        msg = await read_message(reader)
+        serializer = util.get_serializer_by_id(msg.serializer_id)
+        try:
+            if msg.type != message.MSG_CONNECT:
+                raise errors.ProtocolError("expected a connect message")
+            data = serializer.deserializeData(msg.data, msg.flags & message.FLAGS_COMPRESSED)
+            obj = self.objects.get(data["object"])
+            if obj is None:
+                raise errors.DaemonError("unknown object")
+            response, flags = "hello", 0
+            if msg.flags & message.FLAGS_META_ON_CONNECT:
+                response = {"handshake": "hello",
+                            "meta": util.get_exposed_members(obj, as_lists=True)}
+                flags = message.FLAGS_META_ON_CONNECT
+            reply = Message(message.MSG_CONNECTOK, serializer.serializeData(response)[0],
+                            serializer.serializer_id, flags, msg.seq)
+        except Exception as exc:
+            reply = Message(message.MSG_CONNECTFAIL, serializer.serializeData(str(exc))[0],
+                            serializer.serializer_id, 0, msg.seq)
+        writer.write(reply.to_bytes())
+        await writer.drain()
+        return reply.type == message.MSG_CONNECTOK
+
+    async def handle(self, msg):
+        # => the reply to a request, None for oneway calls. like a Pyro4
+        # daemon, we send the caller's trace id (correlation id) back,
+        # with the call's stage timings
+        serializer = util.get_serializer_by_id(msg.serializer_id)
+        if msg.type == message.MSG_PING:
+            return Message(message.MSG_PING, b"pong", msg.serializer_id, 0, msg.seq)
+        annotations = {key: value for key, value in msg.annotations.items() if key == "CORR"}
+        try:
+            if msg.type != message.MSG_INVOKE or msg.flags & message.FLAGS_BATCH:
+                raise errors.ProtocolError("unsupported request")
+            objectId, method, vargs, kwargs = serializer.deserializeCall(
+                msg.data, compressed=msg.flags & message.FLAGS_COMPRESSED)
+            if objectId == constants.DAEMON_NAME:
+                result = self.daemon_call(method, vargs)
+            else:
+                obj = self.objects.get(objectId)
+                if obj is None:
+                    raise errors.DaemonError("unknown object")
+                result = util.getAttribute(obj, method)(*vargs, **kwargs)
+                if isawaitable(result):
+                    result = await result
+            annotations.update(metrics.reply_annotations())
+            if msg.flags & message.FLAGS_ONEWAY:
+                return None
+            data, _ = serializer.serializeData(result)
+            return Message(message.MSG_RESULT, data, serializer.serializer_id, 0, msg.seq, annotations)
+        except Exception as exc:
+            annotations.update(metrics.reply_annotations())
+            return exception_reply(serializer, msg.seq, exc, annotations)
+
+    def daemon_call(self, method, vargs):
+        # the few calls proxies make on the daemon itself
+        if method == "ping":
+            return None
+        if method == "get_metadata":
+            obj = self.objects.get(vargs[0])
+            if obj is None:
+                raise errors.DaemonError("unknown object")
+            return util.get_exposed_members(obj, as_lists=True)
+        raise AttributeError("unknown daemon method %s" % method)
+
+
+class Proxy:
+    # calls a Pyro4 object from the event loop:
+    #
+    #   async with Proxy(uri) as peer:
+    #       t = await peer.get_timestamp()
+    #
+    # send() returns a future instead, so that up to max_in_flight calls
+    # can be pipelined on the connection. the server handles them in the
+    # order they were sent (Pyro4 daemons handle one call per connection
+    # at a time). connection problems raise Pyro4's CommunicationErrors
+    # and remote exceptions are raised again here, like with a Pyro4.Proxy.
+    def __init__(self, uri, timeout=10, max_in_flight=1, serializer=None):
+        self.uri = Pyro4.URI(uri) if isinstance(uri, str) else uri
+        self.timeout = timeout
+        self.max_in_flight = max_in_flight
+        self.serializer = util.get_serializer(serializer or Pyro4.config.SERIALIZER)
+        self.seq = 0
+        self.queue = deque()  # messages not sent yet
+        self.pending = {}  # seq => future of the reply, sent or not
+        self.in_flight = 0
+        self.sent = 0  # bytes
+        self.wakeup = asyncio.Event()  # set when we may be able to send
+        self.task = None
+        self.writer = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
+
+    def close(self, exc=None):
+        # fail the calls we didn't get a reply to, the next call connects again
+        if self.task is not None and self.task is not asyncio.current_task():
+            self.task.cancel()
+        if self.writer is not None:
+            self.writer.close()
+        self.task = self.writer = None
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(exc or errors.ConnectionClosedError("proxy closed"))
+        self.pending.clear()
+        self.queue.clear()
+        self.in_flight = 0
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+
+        async def method(*args, **kwargs):
+            return await self.call(name, *args, **kwargs)
+        return method
+
+    def send(self, method, *args, **kwargs):
+        # => future of the result of the call
+        future = asyncio.get_running_loop().create_future()
+        self.seq = (self.seq + 1) & 0xffff
+        data, _ = self.serializer.serializeCall(self.uri.object, method, args, kwargs)
+        self.queue.append(Message(message.MSG_INVOKE, data, self.serializer.serializer_id, 0, self.seq))
+        self.pending[self.seq] = future
+        self.wakeup.set()
+        if self.task is None:
+            self.task = asyncio.ensure_future(self.run())
+        return future
+
+    async def call(self, method, *args, **kwargs):
+        try:
+            return await asyncio.wait_for(self.send(method, *args, **kwargs), self.timeout)
+        except asyncio.TimeoutError:
+            # the server handles our calls in order, so the ones after
+            # this one would be stuck behind it: give up on the connection
+            self.close(errors.ConnectionClosedError("connection to %s dropped after a timeout" % self.uri))
+            raise errors.TimeoutError("receiving: timeout") from None
+
+    async def run(self):
+        # connect, then send the queued messages while a task reads the replies
+        reader = None
+        try:
+            reader, self.writer = await self.connect()
+            receiving = asyncio.ensure_future(self.receive(reader))
+            try:
+                while True:
+                    await self.wakeup.wait()
+                    self.wakeup.clear()
+                    while self.queue and self.in_flight < self.max_in_flight:
+                        self.in_flight += 1
+                        data = self.queue.popleft().to_bytes()
+                        self.sent += len(data)
+                        self.writer.write(data)
+                    await self.writer.drain()
+            finally:
+                receiving.cancel()
+        except (OSError, errors.PyroError, asyncio.TimeoutError) as exc:
+            self.close(errors.ConnectionClosedError("connection to %s lost: %s" % (self.uri, exc)))
+
+    async def receive(self, reader):
+        try:
+            while True:
+                reply = await read_message(reader)
+                future = self.pending.pop(reply.seq, None)
+                self.in_flight -= 1
+                self.wakeup.set()
+                if future is None or future.done():
+                    # timed out
+                    continue
+                result = self.serializer.deserializeData(reply.data, reply.flags & message.FLAGS_COMPRESSED)
+                if reply.flags & message.FLAGS_EXCEPTION:
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+        except errors.CommunicationError as exc:
+            self.close(exc)
+
+    async def connect(self):
+        if self.uri.protocol != "PYRO":
+            raise errors.PyroError("can only connect to PYRO uris")
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(self.uri.host, self.uri.port), self.timeout)
+        except (OSError, asyncio.TimeoutError) as exc:
+            raise errors.CommunicationError("cannot connect to %s" % self.uri) from exc
+        data, _ = self.serializer.serializeData({"handshake": "hello", "object": self.uri.object})
+        writer.write(Message(message.MSG_CONNECT, data, self.serializer.serializer_id, 0, 0).to_bytes())
+        await writer.drain()
+        reply = await asyncio.wait_for(read_message(reader), self.timeout)
+        if reply.type != message.MSG_CONNECTOK:
+            writer.close()
+            raise errors.CommunicationError("connection to %s rejected: %s" % (
+                self.uri, self.serializer.deserializeData(reply.data)))
+        return reader, writer
@@ -0,0 +1,52 @@
+import asyncio
+
+import Pyro4
+
+import aio
+import serializer
+
+
+class AsyncFrontend:
+    # the session frontend's operations, returning futures:
+    #
+    #   frontend = await AsyncFrontend.connect()
+    #   done = [frontend.add_rating(1, movie_id, 4.5) for movie_id in ids]
+    #   data = await frontend.get_user_data(1)  # sees all of these ratings
+    #   await asyncio.gather(*done)
+    #
+    # requests are pipelined on one connection, up to max_in_flight at a
+    # time, and the frontend handles them one after another in the order
+    # they were made. so a request always sees the effects of the ones
+    # before it, without waiting for their replies.
+    def __init__(self, uri, max_in_flight=64, timeout=60):
+        self.proxy = aio.Proxy(uri, timeout, max_in_flight, serializer.NAME)
+
+    @classmethod
+    async def connect(cls, max_in_flight=64, timeout=60):
+        def lookup():
+            with Pyro4.locateNS() as ns:
+                return ns.lookup("frontend")
+        uri = await asyncio.get_running_loop().run_in_executor(None, lookup)
+        return cls(uri, max_in_flight, timeout)
+
+    def close(self):
+        self.proxy.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
+
+
+def operation(name):
+    def method(self, *args, **kwargs):
+        return self.proxy.send(name, *args, **kwargs)
+    method.__name__ = name
+    return method
+
+
+for name in ("forget", "get_timestamp", "get_user_data", "list_movies",
+             "search", "get_movie", "add_rating", "delete_rating",
+             "add_tag", "remove_tag", "add_movie"):
+    setattr(AsyncFrontend, name, operation(name))
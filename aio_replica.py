@@ -0,0 +1,266 @@
+import asyncio
+import sys
+from threading import get_ident
+from time import perf_counter, time
+
+import Pyro4
+from Pyro4.errors import CommunicationError, NamingError
+
+import aio
+import metrics
+import serializer
+import vector_clock as vc
+from models import Entry, op_from_raw
+from replica import Replica
+from utils import generate_id, ignore_disconnects, ignore_status_errors, \
+        unregister_at_exit, count_requests
+
+
+@count_requests
+class AioReplica(Replica):
+    # a replica serving its RPCs and gossiping on one event loop: reads
+    # waiting for updates and calls to peers are coroutines instead of
+    # threads. only reconstructs run on a thread, to keep the loop free.
+    def __init__(self, id, crdt=False):
+        super().__init__(id, crdt)
+        self.loop = asyncio.get_running_loop()
+        self.thread = get_ident()
+        self.wakeup = asyncio.Event()  # set on new updates, local or gossiped
+        self.changed = asyncio.Event()  # set (and replaced) when self.ts changes
+
+    def notify_applied(self):
+        if get_ident() == self.thread:
+            self.wake_readers()
+        else:
+            # a reconstruct on another thread
+            self.loop.call_soon_threadsafe(self.wake_readers)
+
+    def wake_gossip(self):
+        if get_ident() == self.thread:
+            self.wakeup.set()
+        else:
+            self.loop.call_soon_threadsafe(self.wakeup.set)
+
+    def wake_readers(self):
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    async def wait_for(self, ts, bound=0, patience=20, deps=()):
+        # like Replica.spin()
+        deadline = time() + patience
+        start = perf_counter()
+        while vc.missing(self.ts, ts) > bound or not self.executed_ids.issuperset(deps):
+            self.pull(ts)
+            remaining = deadline - time()
+            if remaining <= 0:
+                self.spin_timeouts += 1
+                metrics.add("spin", perf_counter() - start)
+                raise RuntimeError("Cannot retrieve value!")
+            try:
+                await asyncio.wait_for(self.changed.wait(), min(remaining, self.sync_period))
+            except asyncio.TimeoutError:
+                pass
+        self.spin_wait.observe(perf_counter() - start)
+        metrics.add("spin", perf_counter() - start)
+
+    # peers
+
+    async def reconcile_membership(self):
+        with ignore_disconnects():
+            async with aio.Proxy(self.ns._pyroUri) as ns:
+                replicas = await ns.list(metadata_all={"replica"})
+            self.membership.reconcile({name.split(":", 1)[1]: uri
+                                       for name, uri in replicas.items()})
+
+    async def join(self):
+        await self.reconcile_membership()
+        for id, uri in self.membership.select(self.fanout):
+            with ignore_disconnects(), ignore_status_errors():
+                async with aio.Proxy(uri) as peer:
+                    t = await peer.get_timestamp()
+                if vc.missing(self.sync_ts, t) > self.bootstrap_threshold:
+                    await self.bootstrap(uri)
+                break
+        self.bootstrapping = False
+
+    async def bootstrap(self, uri):
+        self.bootstrapping = True
+        try:
+            async with aio.Proxy(uri) as peer:
+                sid, ts = await self.read_from(peer.open_snapshot)
+                db, log, start = type(self.db)(), [], 0
+                while start is not None:
+                    items, start = await self.read_from(peer.read_snapshot, sid, start, self.chunk_size)
+                    for table, key, value in items:
+                        if table == "log":
+                            log.append(Entry.from_raw(value))
+                        else:
+                            db.restore(table, key, value)
+                until = await self.read_from(peer.get_timestamp)
+                suffix = await self.read_from(peer.get_updates, ts, until)
+                with ignore_status_errors():
+                    await peer.close_snapshot(sid)
+            self.install(db, log, ts, suffix)
+        except (RuntimeError, ConnectionError, CommunicationError, TimeoutError):
+            pass
+        finally:
+            self.bootstrapping = False
+
+    async def read_from(self, f, *args, patience=30):
+        deadline = time() + patience
+        while True:
+            with ignore_status_errors():
+                return await f(*args)
+            if time() > deadline:
+                raise RuntimeError("peer offline")
+            await asyncio.sleep(0.5)
+
+    async def gossip(self):
+        await self.join()
+        last_ns = 0
+        while True:
+            now = self.clock()
+            if now - last_ns >= self.ns_period or not self.membership.view:
+                await self.reconcile_membership()
+                last_ns = now
+            if self.housekeeping(now):
+                await self.loop.run_in_executor(None, self.reconstruct)
+                self.last_change = self.clock()
+            if self.lagging is not None:
+                await self.bootstrap(self.lagging)
+                self.lagging = None
+            # wait for the period to end, or for a local update
+            await asyncio.sleep(self.min_sync_period)
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.sync_period - self.min_sync_period)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            if not self.is_online or self.forced_offline:
+                continue
+            self.membership.beat()
+            self.adapt(await self.gossip_round())
+
+    async def gossip_round(self):
+        # gossip to the peers at the same time
+        peers = self.membership.select(self.fanout)
+        results = await asyncio.gather(*(self.gossip_to(uri) for _, uri in peers))
+        behind = 0
+        for (id, _), result in zip(peers, results):
+            self.membership.report(id, result is not None)
+            behind += bool(result)
+        return behind
+
+    async def gossip_to(self, uri):
+        # => whether we had to send the peer any updates, None if we
+        # couldn't reach it
+        with ignore_disconnects(), ignore_status_errors():
+            async with aio.Proxy(uri) as peer:
+                t, view = await peer.exchange_views(self.membership.export())
+                self.membership.merge(view)
+                ts, events = self.events_for(str(uri), t)
+                if len(events) > self.digest_threshold:
+                    events = []
+                    origins = self.differing_origins(await peer.get_digests())
+                    if origins:
+                        events = self.differing_events(origins, await peer.get_digests(origins))
+                if not events:
+                    self.count_gossip(uri, events)
+                    return False
+                sent = peer.sent
+                await peer.sync(events, ts)
+                self.count_gossip(uri, events, peer.sent - sent)
+                return True
+        return None
+
+    def start_pull(self, origins, since, until):
+        self.loop.create_task(self.pull_from(origins, since, until))
+
+    async def pull_from(self, origins, since, until):
+        try:
+            for origin in origins:
+                with ignore_disconnects(), ignore_status_errors():
+                    uri = self.membership.lookup(origin)
+                    if uri is None:
+                        async with aio.Proxy(self.ns._pyroUri) as ns:
+                            uri = await ns.lookup("replica:%s" % origin)
+                    async with aio.Proxy(uri) as peer:
+                        log = await peer.get_updates(since, until)
+                    if log and self.pulled(log, until):
+                        return
+        except NamingError:
+            pass
+        finally:
+            self.pulling = False
+
+    # reads wait on the loop instead of blocking a thread
+
+    @Pyro4.expose
+    async def list_movies(self, ts, bound=0):
+        self.check_status()
+        await self.wait_for(ts, bound)
+        with self.lock:
+            return self.movie_list(), self.ts
+
+    @Pyro4.expose
+    async def search(self, name, genres, ts, bound=0):
+        self.check_status()
+        await self.wait_for(ts, bound)
+        with self.lock:
+            return self.search_movies(name, genres), self.ts
+
+    @Pyro4.expose
+    async def get_movie(self, movie_id, ts, bound=0):
+        self.check_status()
+        await self.wait_for(ts, bound)
+        with self.lock:
+            return self.movie_data(movie_id), self.ts
+
+    @Pyro4.expose
+    async def get(self, user_id, ts, bound=0):
+        self.check_status()
+        await self.wait_for(ts, bound)
+        with self.lock:
+            return self.user_data(user_id), self.ts
+
+    # and so do CRDT updates, see Replica.causal_past()
+
+    @Pyro4.expose
+    async def update(self, raw, ts, id=None, deps=()):
+        self.check_status()
+        if self.crdt:
+            await self.wait_for(ts, deps=deps)
+        with self.lock:
+            return self.add_update(op_from_raw(raw), ts, id, deps)
+
+    @Pyro4.expose
+    async def commit_update(self, id):
+        self.check_status()
+        update, ts = self.tentative[id]
+        if self.crdt:
+            await self.wait_for(ts)
+        with self.lock:
+            self.tentative.pop(id)
+            return self.add_update(update, ts, id)
+
+
+async def main(id, crdt):
+    r = AioReplica(id, crdt)
+    daemon = aio.Daemon()
+    await daemon.start()
+    uri = daemon.register(r, r.id)
+    r.membership.uri = str(uri)
+    with Pyro4.locateNS() as ns:
+        ns.register("replica:%s" % r.id, uri, metadata={"replica"})
+    unregister_at_exit("replica:%s" % r.id, r.shutdown)
+    await r.gossip()
+
+
+if __name__ == '__main__':
+    serializer.configure()
+    # python aio_replica.py [id] [--crdt]; generate id if necessary
+    args = [arg for arg in sys.argv[1:] if arg != "--crdt"]
+    id = generate_id(5)
+    if len(args) == 1 and args[0]:
+        id = args[0]
+    asyncio.run(main(id, "--crdt" in sys.argv[1:]))
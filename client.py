@@ -1,6 +1,8 @@
+import random
 import textwrap
 import Pyro4
 from Pyro4.errors import ConnectionClosedError, CommunicationError, TimeoutError
+import serializer
 
 
 def similar(a, b):
@@ -44,6 +46,32 @@ def get_integer(prompt):
             return int(x)
 
 
+class TokenFrontend:
+    # wraps a stateless frontend: passes our causal token with every
+    # call and keeps the one that comes back with the reply
+    def __init__(self, proxy, token=""):
+        self.proxy = proxy
+        self.token = token
+
+    def __getattr__(self, name):
+        method = getattr(self.proxy, name)
+
+        def call(*args, **kwargs):
+            result, self.token = method(self.token, *args, **kwargs)
+            return result
+        return call
+
+
+def connect_frontend(token=""):
+    # pick a random stateless frontend if there are any, otherwise
+    # fall back to the session frontend
+    ns = Pyro4.locateNS()
+    uris = list(ns.list(metadata_all={"frontend"}).values())
+    if uris:
+        return TokenFrontend(Pyro4.Proxy(random.choice(uris)), token)
+    return Pyro4.Proxy(ns.lookup("frontend"))
+
+
 class Session:
     def __init__(self, frontend, user_id):
         self.frontend = frontend
@@ -96,11 +124,14 @@ class Session:
             except (ConnectionError, ConnectionClosedError, CommunicationError, TimeoutError):
                 print(" [!] Error: Cannot connect to frontend.")
                 print(" [!] Retrying...")
+                # a stateless frontend's causal token survives the reconnect
+                stateless = isinstance(self.frontend, TokenFrontend)
                 try:
-                    self.frontend = Pyro4.locateNS().lookup("frontend")
+                    self.frontend = connect_frontend(self.frontend.token if stateless else "")
                     self.frontend.get_timestamp()
                     print(" OK.")
-                    print(" Warning: Data might be stale.")
+                    if not stateless:
+                        print(" Warning: Data might be stale.")
                 except:
                     print(" [!] Error: Cannot reconnect.")
                     print(" [!] Bye.")
@@ -248,7 +279,7 @@ class Session:
 def main():
     user_id = get_integer("User ID (Integer): ")
     try:
-        frontend = Pyro4.Proxy(Pyro4.locateNS().lookup("frontend"))
+        frontend = connect_frontend()
     except:
         print(" [!] Error: Cannot connect to frontend.")
         print(" [!] Bye.")
@@ -257,4 +288,5 @@ def main():
 
 
 if __name__ == '__main__':
+    serializer.configure()
     main()
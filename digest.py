@@ -0,0 +1,57 @@
+from hashlib import blake2b
+
+
+# digests of a replica's log + buffer, for anti-entropy between replicas
+# that have drifted far apart. entries are bucketed by their origin and
+# by ranges of the origin's sequence number (its entry in the timestamp):
+#
+#   {origin: {bucket: [hash, entries]}}
+#
+# the hash of a bucket is the XOR of the hashes of the ids of its entries,
+# so buckets can be updated as entries come in. the hash of an origin is
+# the XOR of its buckets.
+
+SIZE = 64
+
+
+def create():
+    return {}
+
+
+def entry_hash(e):
+    uid = ("%s:%s" % (e.id, e.node_id)).encode()
+    return int.from_bytes(blake2b(uid, digest_size=8).digest(), "big")
+
+
+def add(d, e):
+    # e must not have been added before
+    buckets = d.setdefault(e.node_id, {})
+    bucket = buckets.setdefault(e.ts[e.node_id] // SIZE, [0, []])
+    bucket[0] ^= entry_hash(e)
+    bucket[1].append(e)
+
+
+def origins(d):
+    summary = {}
+    for origin, buckets in d.items():
+        h = 0
+        for bucket in buckets.values():
+            h ^= bucket[0]
+        summary[origin] = h
+    return summary
+
+
+def buckets(d, origins):
+    return {origin: {n: bucket[0] for n, bucket in d.get(origin, {}).items()}
+            for origin in origins}
+
+
+def differ(h1, h2):
+    return [key for key in set(h1) | set(h2) if h1.get(key) != h2.get(key)]
+
+
+def entries(d, origin, buckets):
+    found = d.get(origin, {})
+    for n in buckets:
+        if n in found:
+            yield from found[n][1]
@@ -1,52 +1,358 @@
+import sys
+import gzip
+import json
+import marshal
 import Pyro4
 import time
 import random
-from vector_clock import merge
+import uuid
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from collections import OrderedDict, defaultdict, deque
+from functools import wraps
+from threading import Lock, Thread, local
+from vector_clock import merge, missing, geq
 from utils import ignore_disconnects, unregister_at_exit, generate_id, ignore_status_errors
 from models import AddTag, RemoveTag, Delete, Update, UpdateMovie
+import metrics
+import serializer
+from profiler import profiler
+
+
+class ClusterClock:
+    # merged cluster timestamp shared by all sessions. it is refreshed
+    # by a background quorum read, and merged with every timestamp that
+    # piggybacks on a replica reply in between.
+    # we also remember the last known state timestamp of each replica,
+    # and what the cluster timestamp was at each quorum read, and the
+    # replicas the name server listed, which are refreshed along with it
+    def __init__(self, period=1, history=120, listing=5):
+        self.lock = Lock()
+        self.period = period
+        self.ts = {}
+        self.refreshed = 0
+        self.replicas = {}
+        self.listing = listing  # seconds a listing is good for without a refresh
+        self.uris = []
+        self.listed = 0
+        self.history = deque(maxlen=history)  # (time, ts)
+
+    def observe(self, ts, quorum=False):
+        with self.lock:
+            self.ts = merge(self.ts, ts)
+            if quorum:
+                self.refreshed = time.time()
+                self.history.append((self.refreshed, self.ts))
+            return self.ts
+
+    def at(self, t):
+        # cluster timestamp as of time t, as far as we know
+        with self.lock:
+            for refreshed, ts in reversed(self.history):
+                if refreshed <= t:
+                    return ts
+            return self.history[0][1] if self.history else {}
+
+    def staleness(self, ts):
+        # how far behind the cluster a state at ts is: the number of
+        # updates it misses, and how long ago the cluster was no newer
+        # than it (None => longer ago than we remember)
+        with self.lock:
+            n = missing(ts, self.ts)
+            age = 0 if n == 0 else None
+            now = time.time()
+            for refreshed, cluster_ts in reversed(self.history if n else ()):
+                if geq(ts, cluster_ts):
+                    age = now - refreshed
+                    break
+            return {"missing": n, "age": age}
+
+    def observe_replica(self, uri, ts):
+        with self.lock:
+            self.replicas[uri] = merge(self.replicas.get(uri, {}), ts)
+
+    def behind(self, uri, ts):
+        # the number of updates in ts the replica at uri was missing,
+        # last we heard
+        with self.lock:
+            return missing(self.replicas.get(uri, {}), ts)
+
+    def route(self, uris, ts, prefer=None):
+        # replicas which already dominate ts come first (our previous
+        # replica before the others), then the most caught-up ones
+        return sorted(uris, key=lambda uri: (
+            self.behind(uri, ts),
+            uri != prefer,
+            random.random(),
+        ))
+
+    def listed_replicas(self, uris=None):
+        # uris => the name server's latest listing. => the last listing,
+        # None if it's too old to use
+        with self.lock:
+            if uris is not None:
+                self.uris, self.listed = uris, time.time()
+            if time.time() - self.listed <= self.listing:
+                return self.uris
+
+    def stable(self):
+        # the timestamp every replica we listed has reached, as far as
+        # we know
+        with self.lock:
+            states = [self.replicas.get(uri, {}) for uri in self.uris]
+        if not states:
+            return {}
+        return {id: min(state.get(id, 0) for state in states) for id in states[0]}
+
+    def get(self, staleness):
+        # None => our last quorum read is older than the given bound
+        with self.lock:
+            if time.time() - self.refreshed <= staleness:
+                return self.ts
+
+
+class ResultCache:
+    # query results shared by all sessions. each result is stored with
+    # the replica timestamp it was served at and the keys it depends on,
+    # and is evicted in LRU order once the cached results hold more than
+    # `size` items in total.
+    def __init__(self, size=50000):
+        self.lock = Lock()
+        self.size = size
+        self.used = 0
+        self.entries = OrderedDict()  # query => (data, ts, keys, weight)
+        self.index = defaultdict(set)  # key => queries
+
+    def get(self, query, ts, bound=0):
+        # a result can be used if it reflects all but `bound` updates in ts
+        with self.lock:
+            entry = self.entries.get(query)
+            if entry is None or missing(entry[1], ts) > bound:
+                return None
+            self.entries.move_to_end(query)
+            return entry[0], entry[1]
+
+    def put(self, query, keys, data, ts):
+        weight = 1 + (len(data) if isinstance(data, dict) else 0)
+        with self.lock:
+            self.remove(query)
+            self.entries[query] = (data, ts, keys, weight)
+            self.used += weight
+            for key in keys:
+                self.index[key].add(query)
+            while self.used > self.size:
+                self.remove(next(iter(self.entries)))
+
+    def invalidate(self, keys):
+        with self.lock:
+            for key in keys:
+                for query in list(self.index.get(key, ())):
+                    self.remove(query)
+
+    def remove(self, query):
+        # lock must be held
+        if query not in self.entries:
+            return
+        _, _, keys, weight = self.entries.pop(query)
+        self.used -= weight
+        for key in keys:
+            self.index[key].discard(query)
+            if not self.index[key]:
+                del self.index[key]
+
+
+class Tracer:
+    # latency histograms of the frontend's operations, and the traces of
+    # the slow ones: how long each stage took, on the frontend and on the
+    # replicas (stages named "<replica id>/<stage>"), by trace id. the
+    # trace id is Pyro4's correlation id, which proxies send along with
+    # every call made while handling the operation.
+    def __init__(self, slow=0.1, keep=200):
+        self.lock = Lock()
+        self.slow = slow  # seconds
+        self.latency = defaultdict(lambda: metrics.Histogram(metrics.LATENCY))
+        self.traces = deque(maxlen=keep)  # the latest slow ones
+
+    def operation(self, method):
+        # decorator for the operations, which also captures them if we
+        # were asked to
+        @wraps(method)
+        def wrapper(frontend, *args, **kwargs):
+            context = Pyro4.current_context
+            if context.correlation_id is None:
+                context.correlation_id = uuid.uuid4()
+            spans = metrics.start_trace()
+            started, start, result, ok = time.time(), time.perf_counter(), None, False
+            try:
+                result = method(frontend, *args, **kwargs)
+                ok = True
+                return result
+            finally:
+                metrics.trace.set(None)
+                seconds = time.perf_counter() - start
+                self.record(method.__name__, seconds, str(context.correlation_id), spans)
+                if capture is not None:
+                    capture.record(started, frontend.session_id, method.__name__,
+                                   args, kwargs, seconds, ok, result)
+        return wrapper
+
+    def record(self, name, seconds, trace_id, spans):
+        with self.lock:
+            self.latency[name].observe(seconds)
+            if seconds >= self.slow:
+                self.traces.append({"id": trace_id, "operation": name,
+                                    "time": time.time(), "seconds": seconds,
+                                    "stages": spans})
+
+    def summary(self):
+        # => {operation: {"count", "mean", "p50", "p99", "p999"}}
+        with self.lock:
+            return {name: {"count": h.count,
+                           "mean": h.sum / h.count,
+                           "p50": h.quantile(0.5),
+                           "p99": h.quantile(0.99),
+                           "p999": h.quantile(0.999)}
+                    for name, h in self.latency.items()}
+
+    def slowest(self, n):
+        with self.lock:
+            return sorted(self.traces, key=lambda t: -t["seconds"])[:n]
+
+
+class Capture:
+    # records the operations we handle to a gzipped trace file for
+    # tools/replay.py: a marshalled (start, session, operation, args,
+    # kwargs, seconds, ok, movie id) tuple per operation, where start is
+    # in seconds since the capture began and movie id is the id of the
+    # movie add_movie created. flushed every `period` seconds by a
+    # background thread, so that what we recorded reaches the disk even
+    # if we're killed, and on exit.
+    def __init__(self, path, period=1):
+        self.lock = Lock()
+        self.file = gzip.open(path, "wb")
+        self.started = time.time()
+        self.period = period
+        self.pending = 0  # records since the last flush
+        Thread(target=self.flush_periodically, daemon=True).start()
+
+    def record(self, start, session, name, args, kwargs, seconds, ok, result):
+        created = result if name == "add_movie" else None
+        with self.lock:
+            if self.file.closed:
+                return
+            marshal.dump((start - self.started, session, name, args, kwargs, seconds, ok, created),
+                         self.file)
+            self.pending += 1
+
+    def flush_periodically(self):
+        while not self.file.closed:
+            time.sleep(self.period)
+            with self.lock:
+                if self.pending and not self.file.closed:
+                    self.file.flush()
+                    self.pending = 0
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+class TracedProxy(Pyro4.Proxy):
+    # adds the stage timings replicas send back to the current trace
+    def _pyroResponseAnnotations(self, annotations, msgtype):
+        for stage, seconds in metrics.replied_timings(annotations).items():
+            metrics.add("%s/%s" % (self._pyroUri.object, stage), seconds)
+
+
+clock = ClusterClock()
+cache = ResultCache()
+tracer = Tracer()
+capture = None  # a Capture with --capture
+
+
+def encode_token(ts, deps=None):
+    # => the session timestamp, plus the per key dependencies if any
+    data = [ts, deps] if deps else ts
+    return urlsafe_b64encode(json.dumps(data, separators=(",", ":")).encode()).decode()
+
+
+def decode_token(token):
+    # => (ts, deps)
+    data = json.loads(urlsafe_b64decode(token)) if token else {}
+    if isinstance(data, list):
+        return data[0], data[1]
+    return data, {}
+
+
+def key_name(key):
+    return ":".join(map(str, key))
 
 
 @Pyro4.behavior(instance_mode="session")
 class Frontend:
-    def __init__(self):
-        self.ns = Pyro4.locateNS()
+    # key_deps => updates only depend on the session's earlier updates to
+    # the same users and movies (by id), instead of on everything the
+    # session has seen, so they don't wait for unrelated updates. we only
+    # keep the updates that some replica may not have applied yet, and
+    # at most max_deps of them (the latest ones), so tokens stay small.
+    key_deps = False
+    max_deps = 16
+
+    def __init__(self, ns=None, proxies=None):
+        self.ns = ns or Pyro4.locateNS()
+        self.session_id = generate_id(6)
         self.ts = {}
+        self.deps = {}  # key name => [id, ts] of our last update to it, oldest first
         self._replica = None
+        self._proxies = {} if proxies is None else proxies
 
-    def list_replicas(self):
-        with self.ns:
-            return list(self.ns.list(metadata_all={"replica"}).values())
+    def list_replicas(self, cached=True):
+        # cached => the listing refresh_clock keeps, unless it's too old
+        uris = clock.listed_replicas() if cached else None
+        if uris is not None:
+            return uris
+        with self.ns, metrics.stage("ns_lookup"):
+            return clock.listed_replicas(list(self.ns.list(metadata_all={"replica"}).values()))
 
-    def replicas(self, patience=3):
-        # try to give our previous replica if we can
-        with ignore_disconnects(), ignore_status_errors():
-            if self._replica and self._replica.status() == 'online':
-                yield self._replica
-        # otherwise we try to find random replicas that are online
+    def proxy(self, uri):
+        if uri not in self._proxies:
+            self._proxies[uri] = TracedProxy(uri)
+        return self._proxies[uri]
+
+    def replicas(self, ts=None, patience=3):
+        # prefer online replicas that can answer a query depending on
+        # ts without waiting for gossip, and of those the less loaded
+        ts = self.ts if ts is None else ts
         for _ in range(patience):
-            uris = self.list_replicas()
-            random.shuffle(uris)
-            for uri in uris:
-                with ignore_disconnects(), ignore_status_errors():
-                    replica = Pyro4.Proxy(uri)
-                    if replica.status() == 'online':
-                        self._replica = replica
-                        yield self._replica
-            time.sleep(0.05)
+            uris = clock.route(self.list_replicas(), ts, self._replica)
+            while uris:
+                # power of two choices: ask the two most suitable replicas
+                # for their load and try the less loaded one first, unless
+                # the other one is more caught-up with ts
+                loads = []
+                for uri in uris[:2]:
+                    with ignore_disconnects(), metrics.stage("status"):
+                        loads.append((clock.behind(uri, ts), self.proxy(uri).load(), uri))
+                uris = uris[2:]
+                for _, load, uri in sorted(loads, key=lambda l: (l[0], l[1]["score"])):
+                    if load["status"] == 'online':
+                        self._replica = uri
+                        yield self.proxy(uri)
+            with metrics.stage("backoff"):
+                time.sleep(0.05)
         # no replicas accepted => raise exception
         raise RuntimeError("No replica available")
 
-    def execute_on_majority(self, f):
+    def execute_on_majority(self, f, stage="majority"):
         uris = self.list_replicas()
         sent = set()
         patience = 5
         majority = (len(uris) // 2) + 1
         while True:
             for uri in set(uris) - sent:
-                with ignore_status_errors():
+                with ignore_status_errors(), metrics.stage(stage):
                     # if f(replica) proceeds without error, then we have
                     # successfully completed some operation on the replica
-                    f(Pyro4.Proxy(uri))
+                    f(TracedProxy(uri))
                     sent.add(uri)
             patience -= 1
             if len(sent) >= majority:
@@ -54,83 +360,180 @@ class Frontend:
             if patience == 0:
                 raise RuntimeError("cannot get consensus")
             # otherwise relax
-            time.sleep(0.05)
+            with metrics.stage("backoff"):
+                time.sleep(0.05)
 
-    def get_max_timestamp(self):
+    def get_max_timestamp(self, staleness=0):
+        # staleness = how old (in seconds) the cached cluster timestamp
+        # may be before we fall back to a quorum read
+        ts = clock.get(staleness)
+        if ts is not None:
+            return ts
         ts = {}
-        @self.execute_on_majority
+
         def find_max_ts(replica):
             nonlocal ts
-            ts = merge(ts, replica.get_timestamp())
-        return ts
+            sync_ts, state_ts = replica.get_timestamps()
+            clock.observe_replica(str(replica._pyroUri), state_ts)
+            ts = merge(ts, sync_ts)
+        self.execute_on_majority(find_max_ts, "max_timestamp")
+        return clock.observe(ts, quorum=True)
+
+    def refresh_clock(self):
+        while True:
+            try:
+                with ignore_disconnects():
+                    self.list_replicas(cached=False)
+                    self.get_max_timestamp()
+            except RuntimeError:
+                # no quorum right now, try again next period
+                pass
+            time.sleep(clock.period)
 
     @Pyro4.expose
     def forget(self):
         self.ts = {}
+        self.deps = {}
 
     @Pyro4.expose
     def get_timestamp(self):
         return self.ts
 
-    def update_ts(self, ts):
+    def update_ts(self, ts, replica=None):
+        # replica => ts is the state timestamp of the replica that
+        # answered a read
         self.ts = merge(ts, self.ts)
+        clock.observe(ts)
+        if replica is not None:
+            clock.observe_replica(str(replica._pyroUri), ts)
+
+    def requirement(self, consistency):
+        # => (ts, bound): the updates a read has to reflect, and how many
+        # of them it may miss. consistency is one of:
+        #   "causal"           read your writes (session timestamp)
+        #   "any"              whatever the replica has
+        #   ("updates", n)     miss at most n updates known to the cluster
+        #   ("time", seconds)  be at most that old
+        if consistency == "causal":
+            return self.ts, 0
+        if consistency == "any":
+            return {}, 0
+        kind, bound = consistency
+        if kind == "updates":
+            return clock.ts, bound
+        if kind == "time":
+            return clock.at(time.time() - bound), 0
+        raise ValueError("unknown consistency level: %r" % (consistency,))
 
-    def forced_update(self, update):
-        dep = self.get_max_timestamp()
+    def query(self, query, keys, f, consistency="causal", ts=None):
+        # answer from the result cache if possible, otherwise call
+        # f(replica, ts, bound) => (data, ts) and cache the result.
+        # relaxed consistency levels also get told how stale data is.
+        if consistency == "causal" and ts is not None:
+            bound = 0
+        else:
+            ts, bound = self.requirement(consistency)
+        hit = cache.get(query, ts, bound)
+        if hit is not None:
+            data, data_ts = hit
+            self.update_ts(data_ts)
+        else:
+            for replica in self.replicas(ts):
+                with metrics.stage("replica"):
+                    data, data_ts = f(replica, ts, bound)
+                self.update_ts(data_ts, replica)
+                cache.put(query, keys, data, data_ts)
+                break
+        if consistency == "causal":
+            return data
+        return data, clock.staleness(data_ts)
+
+    def forced_update(self, update, staleness):
+        # a cached cluster timestamp might not cover our own latest
+        # writes yet, so depend on those as well
+        dep = merge(self.get_max_timestamp(staleness), self.ts)
         uid = generate_id()
         # prepare
         sent = self.execute_on_majority(
-            lambda r: r.accept_update(uid, update.to_raw(), dep)
+            lambda r: r.accept_update(uid, update.to_raw(), dep), "prepare"
         )
         # commit
         ts = None
         while sent:
-            with ignore_status_errors():
+            with ignore_status_errors(), metrics.stage("commit"):
                 for uri in list(sent):
-                    ts = Pyro4.Proxy(uri).commit_update(uid)
+                    ts = TracedProxy(uri).commit_update(uid)
                     sent.discard(uri)
-            time.sleep(0.05)
+            with metrics.stage("backoff"):
+                time.sleep(0.05)
         self.update_ts(ts)
+        self.depend_on(update, uid, ts)
+
+    def depend_on(self, update, uid, ts):
+        if not self.key_deps:
+            return
+        for key in update.keys():
+            self.deps.pop(key_name(key), None)
+            self.deps[key_name(key)] = [uid, ts]
+        stable = clock.stable()
+        for key, (_, dep_ts) in list(self.deps.items()):
+            if geq(stable, dep_ts):
+                del self.deps[key]
+        while len(self.deps) > self.max_deps:
+            del self.deps[next(iter(self.deps))]
 
-    def send_update(self, update, max=False):
+    def send_update(self, update, max=False, staleness=2):
+        cache.invalidate(update.keys())
         if max:
-            return self.forced_update(update)
+            return self.forced_update(update, staleness)
         for replica in self.replicas():
             # send the update to the first replica we find;
             # if the replica goes offline here then we try
             # the next replica.
-            ts = replica.update(update.to_raw(), self.ts)
+            with metrics.stage("replica"):
+                if self.key_deps:
+                    uid = generate_id()
+                    deps = {self.deps[key_name(key)][0] for key in update.keys()
+                            if key_name(key) in self.deps}
+                    ts = replica.update(update.to_raw(), {}, uid, sorted(deps))
+                    self.depend_on(update, uid, ts)
+                else:
+                    ts = replica.update(update.to_raw(), self.ts)
             self.update_ts(ts)
             return
 
     @Pyro4.expose
-    def get_user_data(self, user_id):
-        for replica in self.replicas():
-            data, ts = replica.get(user_id, self.ts)
-            self.update_ts(ts)
-            return data
+    def get_user_data(self, user_id, consistency="causal"):
+        return self.query(
+            ("get", user_id), {("user", user_id)},
+            lambda replica, ts, bound: replica.get(user_id, ts, bound),
+            consistency,
+        )
 
     @Pyro4.expose
-    def list_movies(self):
-        dep = self.get_max_timestamp()
-        for replica in self.replicas():
-            data, ts = replica.list_movies(dep)
-            self.update_ts(ts)
-            return data
+    def list_movies(self, staleness=2, consistency="causal"):
+        return self.query(
+            ("list_movies",), {("catalog",)},
+            lambda replica, ts, bound: replica.list_movies(ts, bound),
+            consistency,
+            ts=merge(self.get_max_timestamp(staleness), self.ts) if consistency == "causal" else None,
+        )
 
     @Pyro4.expose
-    def search(self, name, genres):
-        for replica in self.replicas():
-            data, ts = replica.search(name, genres, self.ts)
-            self.update_ts(ts)
-            return data
+    def search(self, name, genres, consistency="causal"):
+        return self.query(
+            ("search", name, frozenset(genres)), {("catalog",)},
+            lambda replica, ts, bound: replica.search(name, genres, ts, bound),
+            consistency,
+        )
 
     @Pyro4.expose
-    def get_movie(self, movie_id):
-        for replica in self.replicas():
-            data, ts = replica.get_movie(movie_id, self.ts)
-            self.update_ts(ts)
-            return data
+    def get_movie(self, movie_id, consistency="causal"):
+        return self.query(
+            ("get_movie", movie_id), {("movie", movie_id)},
+            lambda replica, ts, bound: replica.get_movie(movie_id, ts, bound),
+            consistency,
+        )
 
     @Pyro4.expose
     def add_rating(self, user_id, movie_id, value):
@@ -149,16 +552,114 @@ class Frontend:
         self.send_update(RemoveTag(user_id, movie_id, tag))
 
     @Pyro4.expose
-    def add_movie(self, name, genres):
+    def add_movie(self, name, genres, staleness=2):
         id = generate_id(5)
-        self.send_update(UpdateMovie(id, {"name": name, "genres": genres}), max=True)
+        self.send_update(UpdateMovie(id, {"name": name, "genres": genres}),
+                         max=True, staleness=staleness)
         return id
 
+    @Pyro4.expose
+    def latency(self):
+        # => {operation: {"count", "mean", "p50", "p99", "p999"}} in seconds
+        return tracer.summary()
+
+    @Pyro4.expose
+    def slow_traces(self, n=10):
+        # => the n slowest of the latest slow operations, with their stages
+        return tracer.slowest(n)
+
+    @Pyro4.expose
+    def start_profile(self, duration=10, mode="cpu"):
+        # sample the stacks of all our threads, see profiler.py
+        return profiler.start(duration, mode)
+
+    @Pyro4.expose
+    def get_profile(self):
+        return profiler.export()
+
+
+OPERATIONS = ("forget", "get_timestamp", "get_user_data", "list_movies",
+              "search", "get_movie", "add_rating", "delete_rating",
+              "add_tag", "remove_tag", "add_movie")
+
+for name in OPERATIONS:
+    setattr(Frontend, name, Pyro4.expose(tracer.operation(getattr(Frontend, name))))
+
+
+@Pyro4.behavior(instance_mode="single")
+class StatelessFrontend:
+    # the session timestamp travels with every request and reply as an
+    # opaque token, so a client can use any stateless frontend for any
+    # request. name server and replica connections are kept per thread.
+    def __init__(self):
+        self.local = local()
+
+    def session(self, token):
+        if not hasattr(self.local, "ns"):
+            self.local.ns = Pyro4.locateNS()
+            self.local.proxies = {}
+        frontend = Frontend(self.local.ns, self.local.proxies)
+        frontend.ts, frontend.deps = decode_token(token)
+        # a client's calls come in over the same connection
+        address = Pyro4.current_context.client_sock_addr
+        if address:
+            frontend.session_id = "%s:%s" % tuple(address[:2])
+        return frontend
+
+    @Pyro4.expose
+    def latency(self):
+        # => {operation: {"count", "mean", "p50", "p99", "p999"}} in seconds
+        return tracer.summary()
+
+    @Pyro4.expose
+    def slow_traces(self, n=10):
+        # => the n slowest of the latest slow operations, with their stages
+        return tracer.slowest(n)
+
+    @Pyro4.expose
+    def start_profile(self, duration=10, mode="cpu"):
+        # sample the stacks of all our threads, see profiler.py
+        return profiler.start(duration, mode)
+
+    @Pyro4.expose
+    def get_profile(self):
+        return profiler.export()
+
+
+def stateless(name):
+    def method(self, token, *args, **kwargs):
+        frontend = self.session(token)
+        result = getattr(frontend, name)(*args, **kwargs)
+        return result, encode_token(frontend.ts, frontend.deps)
+    method.__name__ = name
+    return Pyro4.expose(method)
+
+
+for name in OPERATIONS:
+    setattr(StatelessFrontend, name, stateless(name))
+
 
 if __name__ == '__main__':
+    serializer.configure()
+    # python frontend.py --stateless => one of many frontends that can be
+    # load-balanced by the clients, otherwise the single session frontend
+    # --key-deps => track causal dependencies per user and movie
+    # --capture <file> => record the operations for tools/replay.py
+    name, metadata, cls = "frontend", set(), Frontend
+    Frontend.key_deps = "--key-deps" in sys.argv[1:]
+    if "--capture" in sys.argv[1:]:
+        capture = Capture(sys.argv[sys.argv.index("--capture") + 1])
+    if "--stateless" in sys.argv[1:]:
+        name = "frontend:%s" % generate_id(5)
+        metadata, cls = {"frontend"}, StatelessFrontend
     with Pyro4.Daemon() as daemon:
-        uri = daemon.register(Frontend, "frontend")
+        uri = daemon.register(cls, "frontend")
         with Pyro4.locateNS() as ns:
-            ns.register("frontend", uri)
-        unregister_at_exit("frontend")
-        daemon.requestLoop()
+            ns.register(name, uri, metadata=metadata)
+        unregister_at_exit(name, capture and capture.close)
+        Thread(target=Frontend().refresh_clock, daemon=True).start()
+        try:
+            daemon.requestLoop()
+        finally:
+            if capture is not None:
+                capture.close()
@@ -0,0 +1,100 @@
+from collections import deque
+from math import log
+from random import random, shuffle
+from threading import Lock
+from time import time
+
+
+class Membership:
+    # our view of the other replicas, spread by gossip: {id: [uri, heartbeat]}
+    # every replica bumps its own heartbeat each round it is online, and we
+    # run a phi accrual failure detector on the times we see a replica's
+    # heartbeat go up (assuming exponentially distributed intervals).
+    def __init__(self, id, threshold=8, retry_period=5, window=100):
+        self.id = id
+        self.uri = None
+        self.lock = Lock()
+        self.threshold = threshold
+        self.retry_period = retry_period
+        self.heartbeat = 0
+        self.view = {}
+        self.arrivals = {}  # id => times the heartbeat went up
+        self.failed = {}  # id => time our last exchange with it failed
+        self.window = window
+        self.clock = time  # virtual in tools/simulate.py
+
+    def beat(self):
+        with self.lock:
+            self.heartbeat += 1
+
+    def export(self):
+        with self.lock:
+            view = {id: list(member) for id, member in self.view.items()}
+            if self.uri is not None:
+                view[self.id] = [self.uri, self.heartbeat]
+            return view
+
+    def merge(self, view):
+        now = self.clock()
+        with self.lock:
+            for id, (uri, heartbeat) in view.items():
+                known = self.view.get(id)
+                if id == self.id or uri is None:
+                    continue
+                if known is None or heartbeat > known[1]:
+                    self.view[id] = [uri, heartbeat]
+                    self.arrivals.setdefault(id, deque(maxlen=self.window)).append(now)
+                    self.failed.pop(id, None)
+
+    def report(self, id, alive):
+        # result of an exchange we started with the replica
+        with self.lock:
+            if alive:
+                self.failed.pop(id, None)
+            else:
+                self.failed[id] = self.clock()
+
+    def phi(self, id, now):
+        # lock must be held
+        arrivals = self.arrivals.get(id)
+        if not arrivals or len(arrivals) < 2:
+            return 0
+        mean = max((arrivals[-1] - arrivals[0]) / (len(arrivals) - 1), 0.01)
+        return (now - arrivals[-1]) / (mean * log(10))
+
+    def select(self, n):
+        # => up to n random (id, uri) pairs of replicas we think are up.
+        # replicas we failed to reach are left alone for a while, and
+        # the ones we suspect are only tried now and then.
+        now = self.clock()
+        with self.lock:
+            peers = []
+            for id, (uri, _) in self.view.items():
+                if id in self.failed and now - self.failed[id] < self.retry_period:
+                    continue
+                if self.phi(id, now) > self.threshold and random() > 0.1:
+                    continue
+                peers.append((id, uri))
+        shuffle(peers)
+        return peers[:n]
+
+    def lookup(self, id):
+        with self.lock:
+            member = self.view.get(id)
+            return member[0] if member else None
+
+    def reconcile(self, registered):
+        # registered = {id: uri} from the name server. add the replicas we
+        # haven't heard of, and forget the ones which are gone from it and
+        # which we failed to reach or suspect.
+        now = self.clock()
+        with self.lock:
+            for id, uri in registered.items():
+                if id != self.id and id not in self.view:
+                    self.view[id] = [uri, 0]
+            for id in list(self.view):
+                suspected = id in self.failed or self.phi(id, now) > self.threshold
+                if id not in registered and suspected:
+                    del self.view[id]
+                    self.arrivals.pop(id, None)
+                    self.failed.pop(id, None)
@@ -16,6 +16,33 @@ class DB:
         self.ratings.clear()
         self.tags.clear()
 
+    def apply(self, e):
+        e.op.apply(self)
+
+    def apply_copy(self, e):
+        # e is another copy of an update we applied before
+        pass
+
+    def snapshot(self):
+        # => (table, key, value) items with copies of our data, for
+        # sending our state to another replica
+        for movie_id, data in self.movies.items():
+            yield "movies", movie_id, data
+        for user_id, ratings in self.ratings.items():
+            yield "ratings", user_id, dict(ratings)
+        for user_id, tags in self.tags.items():
+            yield "tags", user_id, {movie_id: set(t) for movie_id, t in tags.items()}
+
+    def restore(self, table, key, value):
+        # add an item of another replica's snapshot
+        if table == "movies":
+            self.movies[key] = value
+        elif table == "ratings":
+            self.ratings[key].update(value)
+        elif table == "tags":
+            for movie_id, tags in value.items():
+                self.tags[key][movie_id].update(tags)
+
     def update_movie(self, movie_id, data):
         self.movies[movie_id] = data
 
@@ -32,8 +59,8 @@ class DB:
         if movie_id in self.ratings[user_id]:
             del self.ratings[user_id][movie_id]
 
-    @staticmethod
-    def from_data():
+    @classmethod
+    def from_data(cls):
         with open('data/ratings.csv', newline='') as ratings, \
                 open('data/movies.csv', newline='') as movies, \
                 open('data/tags.csv', newline='') as tags:
@@ -44,7 +71,7 @@ class DB:
             next(ratings)
             next(movies)
             next(tags)
-            db = DB()
+            db = cls()
             for id, title, genres in movies:
                 db.movies[id] = {
                     "name": title,
@@ -57,22 +84,106 @@ class DB:
             return db
 
 
+class CRDTDB(DB):
+    # a DB whose updates commute, so applying them in any order gives the
+    # state reconstruct() gets by replaying them sorted by (time, id).
+    # time is a hybrid time which is later than the times of the updates
+    # an update depends on (see Replica.add_update), so that order is a
+    # causal one, and a write always wins over the ones it overwrote.
+    # ratings are last-writer-wins registers stamped with the (time, id)
+    # of the update that wrote them, deletes leaving the stamp behind.
+    # tags are a last-writer-wins element set: each (movie, tag) of a
+    # user is in or out as the latest add or remove says.
+    # forced updates (movies) are added on several replicas with the
+    # same id, and the copy with the earliest time wins, so we keep all
+    # the writes to a movie to pick the latest once every copy is in.
+    def __init__(self):
+        super().__init__()
+        self.stamp = ()  # of the update being applied
+        self.rating_stamps = defaultdict(dict)  # user => movie => stamp
+        self.tag_stamps = defaultdict(dict)  # user => (movie, tag) => stamp
+        self.movie_writes = defaultdict(dict)  # movie => id => [time, data]
+
+    def apply(self, e):
+        self.stamp = (e.time, e.id)
+        e.op.apply(self)
+
+    def apply_copy(self, e):
+        if isinstance(e.op, UpdateMovie):
+            self.apply(e)
+
+    def snapshot(self):
+        yield from super().snapshot()
+        for user_id, stamps in self.rating_stamps.items():
+            yield "rating_stamps", user_id, dict(stamps)
+        for user_id, stamps in self.tag_stamps.items():
+            yield "tag_stamps", user_id, dict(stamps)
+        for movie_id, writes in self.movie_writes.items():
+            yield "movie_writes", movie_id, {id: list(w) for id, w in writes.items()}
+
+    def restore(self, table, key, value):
+        if table in ("rating_stamps", "tag_stamps", "movie_writes"):
+            getattr(self, table)[key].update(value)
+        else:
+            super().restore(table, key, value)
+
+    def newer(self, stamps, key):
+        if self.stamp <= stamps.get(key, ()):
+            return False
+        stamps[key] = self.stamp
+        return True
+
+    def update_movie(self, movie_id, data):
+        time, id = self.stamp
+        writes = self.movie_writes[movie_id]
+        if id in writes:
+            writes[id][0] = min(writes[id][0], time)
+        else:
+            writes[id] = [time, data]
+        latest = max(writes, key=lambda id: (writes[id][0], id))
+        super().update_movie(movie_id, writes[latest][1])
+
+    def add_tag(self, user_id, movie_id, tag):
+        if self.newer(self.tag_stamps[user_id], (movie_id, tag)):
+            super().add_tag(user_id, movie_id, tag)
+
+    def remove_tag(self, user_id, movie_id, tag):
+        if self.newer(self.tag_stamps[user_id], (movie_id, tag)):
+            super().remove_tag(user_id, movie_id, tag)
+
+    def update_rating(self, user_id, movie_id, value):
+        if self.newer(self.rating_stamps[user_id], movie_id):
+            super().update_rating(user_id, movie_id, value)
+
+    def delete_rating(self, user_id, movie_id):
+        if self.newer(self.rating_stamps[user_id], movie_id):
+            super().delete_rating(user_id, movie_id)
+
+
 # Entry => some 'update' operation sent to a replica
 # contains the entry ID, node ID, operation, causal dependency, logical
-# timestamp, and physical timestamp
+# timestamp, physical timestamp, and the IDs of the updates it depends
+# on (only used by frontends tracking dependencies per key, which send
+# an empty causal dependency instead)
 #
 # We don't need `time` to establish a strict ordering, but
 # using `time` is better than using `id` or `node_id` to avoid
-# the entries from jumping around too much.
+# the entries from jumping around too much. It is the replica's
+# clock, pushed past the times of the updates the replica knows
+# about, so an update sorts after the ones it depends on when the
+# replica has them (CRDT replicas wait until they do).
 #
-class Entry(namedtuple('Entry', 'id,node_id,op,prev,ts,time')):
+class Entry(namedtuple('Entry', 'id,node_id,op,prev,ts,time,deps')):
     def to_raw(self):
-        return (self.id, self.node_id, self.op.to_raw(), self.prev, self.ts, self.time)
+        return (self.id, self.node_id, self.op.to_raw(), self.prev, self.ts, self.time, self.deps)
 
     @classmethod
     def from_raw(cls, t):
         e = Entry(*t)
-        return Entry(e.id, e.node_id, op_from_raw(e.op), e.prev, e.ts, e.time)
+        return e._replace(op=op_from_raw(e.op), deps=tuple(e.deps))
+
+
+Entry.__new__.__defaults__ = ((),)
 
 
 def op_from_raw(raw):
@@ -85,7 +196,7 @@ def register(tag):
         REGISTRY[tag] = cls
 
         def to_raw(self):
-            return (tag, self)
+            return (tag, tuple(self))
         cls.to_raw = to_raw
         return cls
     return decorator
@@ -96,18 +207,28 @@ class Update(namedtuple('Update', 'user_id,movie_id,value')):
     def apply(self, db):
         db.update_rating(self.user_id, self.movie_id, self.value)
 
+    def keys(self):
+        return {("user", self.user_id), ("movie", self.movie_id)}
+
 
 @register("D")
 class Delete(namedtuple('Delete', 'user_id,movie_id')):
     def apply(self, db):
         db.delete_rating(self.user_id, self.movie_id)
 
+    def keys(self):
+        return {("user", self.user_id), ("movie", self.movie_id)}
+
 
 @register("M")
 class UpdateMovie(namedtuple('UpdateMovie', 'movie_id,data')):
     def apply(self, db):
         db.update_movie(self.movie_id, self.data)
 
+    def keys(self):
+        # changes what search and list_movies return
+        return {("movie", self.movie_id), ("catalog",)}
+
 
 @register("A")
 class AddTag(namedtuple('AddTag', 'user_id,movie_id,tags')):
@@ -115,9 +236,15 @@ class AddTag(namedtuple('AddTag', 'user_id,movie_id,tags')):
         for tag in self.tags:
             db.add_tag(self.user_id, self.movie_id, tag)
 
+    def keys(self):
+        return {("user", self.user_id), ("movie", self.movie_id)}
+
 
 @register("R")
 class RemoveTag(namedtuple('RemoveTag', 'user_id,movie_id,tags')):
     def apply(self, db):
         for tag in self.tags:
             db.remove_tag(self.user_id, self.movie_id, tag)
+
+    def keys(self):
+        return {("user", self.user_id), ("movie", self.movie_id)}
@@ -0,0 +1,107 @@
+import os
+import re
+import sys
+from collections import Counter
+from threading import Lock, Thread, enumerate as threads, get_ident
+from time import perf_counter, pthread_getcpuclockid, clock_gettime, sleep
+
+
+# a sampling profiler for the threads of a live process (Pyro4's workers,
+# the gossip thread, an event loop...), for flame graphs: every interval,
+# it takes the stack of each thread and counts how often each stack was
+# seen. in "cpu" mode, only the threads which ran since the last sample
+# count, "wall" counts the waiting ones as well. the stacks are rooted at
+# the thread's name (without numbers, so that the workers add up) and
+# exported collapsed, one "root;caller;...;callee count" line per stack.
+#
+# sampling costs about as much as formatting the threads' tracebacks
+# 100 times a second. processes of the replay pool aren't sampled.
+
+MAX_DURATION = 600  # seconds
+
+
+def frame_name(frame):
+    code = frame.f_code
+    return "%s (%s)" % (code.co_name, os.path.basename(code.co_filename))
+
+
+def thread_name(thread):
+    # "Thread-5 (gossip)" => "gossip", "Pyro-Worker-1234" => "Pyro-Worker"
+    name = re.sub(r"^Thread-\d+ \((.*)\)$", r"\1", thread.name)
+    return re.sub(r"[-_ ]?\d+$", "", name) or "thread"
+
+
+def cpu_time(ident):
+    # => CPU seconds used by the thread so far, None if it is gone
+    try:
+        return clock_gettime(pthread_getcpuclockid(ident))
+    except (OSError, OverflowError):
+        return None
+
+
+class Profiler:
+    def __init__(self):
+        self.lock = Lock()
+        self.stacks = Counter()
+        self.mode = None
+        self.samples = 0
+        self.started = self.stopped = 0
+        self.thread = None
+
+    def start(self, duration=10, mode="cpu", interval=0.01):
+        # starts sampling for duration seconds, unless we already are
+        if mode not in ("cpu", "wall"):
+            raise ValueError("unknown profile mode: %r" % (mode,))
+        with self.lock:
+            if self.running:
+                return False
+            self.stacks, self.mode, self.samples = Counter(), mode, 0
+            self.started = perf_counter()
+            self.stopped = self.started + min(duration, MAX_DURATION)
+            self.thread = Thread(target=self.sample, args=(interval,),
+                                 name="profiler", daemon=True)
+            self.thread.start()
+            return True
+
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def sample(self, interval):
+        me = get_ident()
+        used = {}  # thread ident => CPU time at the last sample
+        while perf_counter() < self.stopped:
+            names = {thread.ident: thread_name(thread) for thread in threads()}
+            stacks = []
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                if self.mode == "cpu":
+                    last, used[ident] = used.get(ident), cpu_time(ident)
+                    if last is None or used[ident] is None or used[ident] <= last:
+                        continue
+                stack = []
+                while frame is not None:
+                    stack.append(frame_name(frame))
+                    frame = frame.f_back
+                stack.append(names.get(ident, "thread"))
+                stacks.append(";".join(reversed(stack)))
+            with self.lock:
+                self.stacks.update(stacks)
+                self.samples += 1
+            sleep(interval)
+
+    def export(self):
+        # => {"mode", "running", "seconds", "samples", "stacks"}, where
+        # stacks are the collapsed stacks seen so far
+        with self.lock:
+            end = min(perf_counter(), self.stopped)
+            lines = ["%s %d" % item for item in sorted(self.stacks.items())]
+            return {"mode": self.mode,
+                    "running": self.running,
+                    "seconds": max(0, end - self.started),
+                    "samples": self.samples,
+                    "stacks": "\n".join(lines) + "\n" if lines else ""}
+
+
+profiler = Profiler()
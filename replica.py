@@ -1,143 +1,506 @@
+import os
 import sys
-from time import sleep, time
-from itertools import chain, islice
+from collections import defaultdict
+from time import perf_counter, sleep, time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from itertools import chain
 from contextlib import contextmanager
 from random import random
 
 import Pyro4
-from models import Entry, op_from_raw, DB
-from threading import Lock, Thread
-from utils import generate_id, find_random_peers, ignore_disconnects, \
-        apply_updates, sort_buffer, unregister_at_exit, ignore_status_errors
+from Pyro4.errors import CommunicationError
+from models import Entry, op_from_raw, DB, CRDTDB
+from threading import Lock, Thread, Condition, Event
+from utils import generate_id, ignore_disconnects, apply_updates, \
+        sort_buffer, unregister_at_exit, ignore_status_errors, TimedLock, \
+        count_requests, ByteCounter
+from membership import Membership
 import vector_clock as vc
+import digest
+import metrics
+import serializer
+from profiler import profiler
 
 
+@count_requests
 class Replica:
-    def __init__(self, id):
+    def __init__(self, id, crdt=False):
         self.id = id
-        self.ns = Pyro4.locateNS()
-        self.lock = Lock()
-        # state and updates
-        self.db = DB.from_data()
+        self._ns = None
+        self.clock = time  # virtual in tools/simulate.py
+        self.lock = TimedLock()
+        self.applied = Condition(self.lock)  # notified when self.ts changes
+        # state and updates. crdt => updates commute, so there's no need
+        # to rebuild the state to converge, only to sort the log
+        self.crdt = crdt
+        self.db = (CRDTDB if crdt else DB).from_data()
         self.log = []  # applied updates
         self.buffer = []  # unapplied updates
         self.ts = vc.create()  # timestamp of state
         self.executed_ids = set()
         self.executed_uids = set()
+        self.known_uids = set()  # uids of log + buffer
+        self.digests = digest.create()  # digests of log + buffer
         self.tentative = {}  # waiting for confirmation from frontend
-        # gossip
+        # replay updates split by user on a process pool when there are
+        # at least parallel_threshold of them. the pool is started the
+        # first time that happens
+        self.workers = os.cpu_count() or 1
+        self.parallel_threshold = 20000
+        self.pool = None
+        self.pool_lock = Lock()
+        # gossip. the period and fanout adapt to how busy we are,
+        # between these bounds
         self.sync_period = 2
+        self.min_sync_period = 0.1
+        self.max_sync_period = 5  # heartbeat when idle
+        self.fanout = 5
+        self.min_fanout = 2
+        self.max_fanout = 10
+        self.unsent = 0  # number of new updates since the last round
+        self.wakeup = Event()  # set on new updates, local or gossiped
+        self.reconstruct_period = 10
+        self.status_period = 2
+        self.last_change = self.last_status = self.clock()
+        self.membership = Membership(id)
+        self.ns_period = 30  # how often we check our view with the name server
         self.sync_ts = vc.create()  # timestamp of log + buffer
+        self.latest = 0  # latest time of the updates in log + buffer
+        self.digest_threshold = 64  # compare digests above that many events
+        # state transfer. we copy a peer's state and log instead of
+        # gossiping when we're more than bootstrap_threshold updates
+        # behind it (or when we join), reading it in chunks of about
+        # chunk_size values; and we serve at most max_snapshots copies.
+        self.bootstrapping = True  # until we've joined
+        self.bootstrap_threshold = 1000
+        self.lagging = None  # uri of a peer we're far behind
+        self.chunk_size = 5000
+        self.snapshots = {}  # id => [items, last read]
+        self.max_snapshots = 2
+        self.snapshot_timeout = 60
         self.has_new_gossip = False
         self.need_reconstruct = False
+        self.pulling = False
         # status
         self.is_online = True
         self.forced_offline = False
+        # load; we are overloaded once any of these limits is reached
+        self.requests = 0  # calls in progress
+        self.requests_lock = Lock()
+        self.reconstructing = False
+        self.max_requests = 32
+        self.max_lock_wait = 0.05  # seconds, moving average
+        self.max_buffer = 1000
+        # metrics
+        self.apply_time = metrics.Histogram()
+        self.reconstruct_time = metrics.Histogram()
+        self.spin_wait = metrics.Histogram()
+        self.spin_timeouts = 0
+        self.gossip_sent = defaultdict(lambda: {"rounds_total": 0, "entries_total": 0, "bytes_total": 0})
 
-    def peers(self):
-        with self.ns:
-            peers = find_random_peers(self.ns, self.id, "replica")
-        for peer in peers:
-            peer = Pyro4.Proxy(peer)
-            with ignore_disconnects():
-                if peer.status() != 'online':
-                    peer._pyroRelease()
-                    continue
-            yield peer
+    @property
+    def ns(self):
+        # located when first needed, so that replicas can be built without
+        # a name server (see tools/bench.py)
+        if self._ns is None:
+            self._ns = Pyro4.locateNS()
+        return self._ns
+
+    def reconcile_membership(self):
+        with ignore_disconnects(), self.ns:
+            replicas = self.ns.list(metadata_all={"replica"})
+            self.membership.reconcile({name.split(":", 1)[1]: uri
+                                       for name, uri in replicas.items()})
+
+    def join(self):
+        # catch up with a peer by state transfer if it is far ahead,
+        # before we serve anything
+        self.reconcile_membership()
+        for id, uri in self.membership.select(self.fanout):
+            with ignore_disconnects(), ignore_status_errors():
+                with Pyro4.Proxy(uri) as peer:
+                    t = peer.get_timestamp()
+                if vc.missing(self.sync_ts, t) > self.bootstrap_threshold:
+                    self.bootstrap(uri)
+                break
+        self.bootstrapping = False
+
+    def bootstrap(self, uri):
+        # copy the peer's state and log, chunk by chunk, into a new DB
+        # off the lock, then swap them in and catch up with whatever
+        # came in since. we're offline meanwhile. only called from the
+        # gossip thread.
+        self.bootstrapping = True
+        try:
+            with Pyro4.Proxy(uri) as peer:
+                sid, ts = self.read_from(peer, lambda: peer.open_snapshot())
+                db, log, start = type(self.db)(), [], 0
+                while start is not None:
+                    items, start = self.read_from(peer, lambda: peer.read_snapshot(sid, start, self.chunk_size))
+                    for table, key, value in items:
+                        if table == "log":
+                            log.append(Entry.from_raw(value))
+                        else:
+                            db.restore(table, key, value)
+                suffix = self.read_from(peer, lambda: peer.get_updates(ts, peer.get_timestamp()))
+                with ignore_status_errors():
+                    peer.close_snapshot(sid)
+            self.install(db, log, ts, suffix)
+        except (RuntimeError, ConnectionError, CommunicationError, TimeoutError):
+            # try again after a while, maybe with another peer
+            pass
+        finally:
+            self.bootstrapping = False
+
+    def install(self, db, log, ts, suffix):
+        # swap in a state and log copied from a peer at ts, and the raw
+        # updates it got since
+        with self.lock:
+            entries = list(chain(self.log, self.buffer))
+            self.db, self.log, self.buffer, self.ts = db, log, [], ts
+            self.executed_ids = {e.id for e in log}
+            self.executed_uids = {(e.id, e.node_id) for e in log}
+            self.known_uids = set(self.executed_uids)
+            self.digests = digest.create()
+            for e in log:
+                digest.add(self.digests, e)
+                self.sync_ts = vc.merge(self.sync_ts, e.ts)
+                self.latest = max(self.latest, e.time)
+            # updates of ours the peer doesn't have yet, and the
+            # ones it got since the snapshot
+            self.receive([e.to_raw() for e in entries])
+            self.receive(suffix)
+            self.apply_updates()
+            self.need_reconstruct = True
+
+    def read_from(self, peer, f, patience=30):
+        # peers go offline every now and then, wait for them
+        deadline = time() + patience
+        while True:
+            with ignore_status_errors():
+                return f()
+            if time() > deadline:
+                raise RuntimeError("peer offline")
+            sleep(0.5)
 
     def gossip(self):
-        n = 0
+        self.join()
+        last_ns = 0
         while True:
-            n += 1
-            n %= 6
-            with self.lock:
-                self.is_online = random() <= 0.75
-                if self.has_new_gossip:
-                    self.need_reconstruct = True
-                    self.has_new_gossip = False
-                    self.apply_updates()
-                    n = 0
-                # relax and apply a global order to the updates
-                elif n == 5 and self.need_reconstruct and not self.buffer:
-                    self.need_reconstruct = False
-                    self.reconstruct()
-                    n = 0
-            sleep(self.sync_period)
+            now = self.clock()
+            if now - last_ns >= self.ns_period or not self.membership.view:
+                self.reconcile_membership()
+                last_ns = now
+            if self.housekeeping(now):
+                self.reconstruct()
+                self.last_change = self.clock()
+            if self.lagging is not None:
+                self.bootstrap(self.lagging)
+                self.lagging = None
+            # wait for the period to end, or for a local update
+            sleep(self.min_sync_period)
+            self.wakeup.wait(self.sync_period - self.min_sync_period)
+            self.wakeup.clear()
             # if we're not online, don't gossip!
             if not self.is_online or self.forced_offline:
                 continue
-            # find 5 random peers and gossip to them, if possible
-            for peer in islice(self.peers(), 5):
-                with ignore_disconnects(), ignore_status_errors():
-                    events = []
-                    ts = {}
-                    t = peer.get_timestamp()
-                    with self.lock:
-                        ts = self.sync_ts
-                        if t == ts:
-                            continue
-                        # check if we need to go back past our buffered updates
-                        log = self.buffer
-                        if not vc.greater_than(t, self.ts):
-                            log = chain(self.log, self.buffer)
-                        # get all events which are concurrent or greater than
-                        events = [e.to_raw() for e in log if vc.compare(e.ts, t) >= 0]
-                        if not events:
-                            continue
-                    # gossip with peer
-                    peer.sync(events, ts)
+            self.membership.beat()
+            self.adapt(self.gossip_round())
+
+    def housekeeping(self, now):
+        # go offline now and then, and apply the updates we got by
+        # gossip. => whether it's time to reconstruct.
+        with self.lock:
+            if now - self.last_status >= self.status_period:
+                self.is_online = random() <= 0.75
+                self.last_status = now
+            if self.has_new_gossip:
+                self.need_reconstruct = True
+                self.has_new_gossip = False
+                self.apply_updates()
+                self.last_change = now
+            # relax and apply a global order to the updates
+            elif now - self.last_change >= self.reconstruct_period \
+                    and self.need_reconstruct and not self.buffer:
+                self.need_reconstruct = False
+                return True
+        return False
+
+    def adapt(self, behind):
+        # gossip sooner and to more peers while there are updates we
+        # haven't passed on or peers that are behind us, and back off
+        # towards a slow heartbeat when there is nothing to do
+        with self.lock:
+            busy = self.unsent or behind
+            self.unsent = 0
+        if busy:
+            self.sync_period = max(self.min_sync_period, self.sync_period / 2)
+            self.fanout = min(self.max_fanout, self.fanout + 1)
+        else:
+            self.sync_period = min(self.max_sync_period, self.sync_period * 1.5)
+            self.fanout = max(self.min_fanout, self.fanout - 1)
+
+    def gossip_round(self):
+        # returns the number of peers we had to send updates to
+        behind = 0
+        # pick some random peers from our view and gossip to them
+        for id, uri in self.membership.select(self.fanout):
+            alive = False
+            with ignore_disconnects(), ignore_status_errors():
+                with Pyro4.Proxy(uri) as peer:
+                    behind += self.gossip_to(peer)
+                alive = True
+            self.membership.report(id, alive)
+        return behind
+
+    def gossip_to(self, peer):
+        # => whether we had to send the peer any updates
+        events = []
+        ts = {}
+        t, view = peer.exchange_views(self.membership.export())
+        self.membership.merge(view)
+        ts, events = self.events_for(str(peer._pyroUri), t)
+        # too many to send them all, only send the parts of
+        # our log which differ from the peer's
+        if len(events) > self.digest_threshold:
+            events = self.reconcile(peer)
+        if not events:
+            self.count_gossip(peer._pyroUri, events)
+            return False
+        # gossip with peer
+        counter = peer._pyroConnection = ByteCounter(peer._pyroConnection)
+        peer.sync(events, ts)
+        self.count_gossip(peer._pyroUri, events, counter.sent)
+        return True
+
+    def count_gossip(self, uri, events, size=0):
+        # uri = of the peer we gossip to, size = bytes of the request
+        # which carried the events, as sent by the proxy
+        sent = self.gossip_sent[Pyro4.URI(uri).object]
+        sent["rounds_total"] += 1
+        sent["entries_total"] += len(events)
+        sent["bytes_total"] += size
+
+    def events_for(self, uri, t):
+        # => (our timestamp, raw events) to send to the peer at uri with
+        # timestamp t
+        with self.lock:
+            ts = self.sync_ts
+            if t == ts:
+                return ts, []
+            if vc.missing(ts, t) > self.bootstrap_threshold:
+                self.lagging = uri
+            # check if we need to go back past our buffered updates
+            log = self.buffer
+            if not vc.greater_than(t, self.ts):
+                log = chain(self.log, self.buffer)
+            # get all events which are concurrent or greater than
+            return ts, [e.to_raw() for e in log if vc.compare(e.ts, t) >= 0]
+
+    def reconcile(self, peer):
+        # compare the digests of our logs, first per origin and then per
+        # sequence range, and return our events in the ranges that differ
+        origins = self.differing_origins(peer.get_digests())
+        if not origins:
+            return []
+        return self.differing_events(origins, peer.get_digests(origins))
+
+    def differing_origins(self, theirs):
+        with self.lock:
+            return digest.differ(digest.origins(self.digests), theirs)
+
+    def differing_events(self, origins, theirs):
+        with self.lock:
+            ours = digest.buckets(self.digests, origins)
+            return [e.to_raw() for origin in origins
+                    for e in digest.entries(self.digests, origin, digest.differ(
+                        ours[origin], theirs.get(origin, {})))]
 
     def reconstruct(self):
-        self.ts = {}
-        self.db = DB.from_data()
-        self.executed_ids.clear()
-        self.executed_uids.clear()
-        self.log, self.buffer = [], self.log
-        self.apply_updates()
+        # rebuild the state from a frozen copy of the log without holding
+        # the lock, then catch up with the updates that came in meanwhile
+        # and swap the new state in. only called from the gossip thread,
+        # which is the only one replacing self.log.
+        start = perf_counter()
+        if self.crdt:
+            with self.lock:
+                sort_buffer(self.log)
+            self.reconstruct_time.observe(perf_counter() - start)
+            return
+        with self.lock:
+            self.reconstructing = True
+            log = self.log
+            n = len(log)
+        try:
+            db = DB.from_data()
+            executed_ids = set()
+            executed_uids = set()
+            new_log = []
+            buffer = log[:n]
+            sort_buffer(buffer)
+            ts, buffer = apply_updates({}, db, executed_ids, executed_uids,
+                                       new_log, buffer, *self.replay_pool(buffer))
+            with self.lock:
+                # log only grows while we don't hold the lock
+                buffer.extend(log[n:])
+                buffer.extend(self.buffer)
+                sort_buffer(buffer)
+                self.ts, self.buffer = apply_updates(ts, db, executed_ids,
+                                                     executed_uids, new_log,
+                                                     buffer)
+                self.db = db
+                self.log = new_log
+                self.executed_ids = executed_ids
+                self.executed_uids = executed_uids
+                self.notify_applied()
+        finally:
+            self.reconstructing = False
+        self.reconstruct_time.observe(perf_counter() - start)
 
     def apply_updates(self):
+        start = perf_counter()
         sort_buffer(self.buffer)
         self.ts, self.buffer = apply_updates(self.ts, self.db,
                                              self.executed_ids,
                                              self.executed_uids,
-                                             self.log, self.buffer)
+                                             self.log, self.buffer,
+                                             *self.replay_pool(self.buffer))
+        self.notify_applied()
+        self.apply_time.observe(perf_counter() - start)
+
+    def notify_applied(self):
+        # lock must be held. wake up the reads waiting for updates
+        self.applied.notify_all()
+
+    def replay_pool(self, buffer):
+        # => (pool, partitions) arguments for apply_updates. the workers
+        # replay onto plain DBs, so not for CRDT replicas
+        if self.workers == 1 or self.crdt or len(buffer) < self.parallel_threshold:
+            return None, 1
+        with self.pool_lock:
+            if self.pool is None:
+                self.pool = ProcessPoolExecutor(self.workers, mp_context=get_context("spawn"))
+            return self.pool, self.workers
+
+    def shutdown(self):
+        # on exit
+        with self.pool_lock:
+            if self.pool is not None:
+                self.pool.shutdown(wait=False, cancel_futures=True)
 
     @contextmanager
-    def spin(self, ts, patience=10):
+    def spin(self, ts, bound=0, patience=20, deps=()):
         # wait until we can respond to the query, or until
-        # we run out of patience
-        while True:
-            with self.lock:
-                # can respond
-                if vc.geq(self.ts, ts):
-                    yield
-                    return
-            patience -= 1
-            if patience == 0:
-                raise RuntimeError("Cannot retrieve value!")
-            sleep(self.sync_period)
+        # we run out of patience (in seconds). bound = number
+        # of updates in ts that the query can do without.
+        # deps = ids of updates we have to have applied as well.
+        deadline = time() + patience
+        with self.applied:
+            start = perf_counter()
+            while vc.missing(self.ts, ts) > bound or not self.executed_ids.issuperset(deps):
+                # don't wait for push gossip, go and get them
+                self.pull(ts)
+                remaining = deadline - time()
+                if remaining <= 0:
+                    self.spin_timeouts += 1
+                    metrics.add("spin", perf_counter() - start)
+                    raise RuntimeError("Cannot retrieve value!")
+                self.applied.wait(min(remaining, self.sync_period))
+            self.spin_wait.observe(perf_counter() - start)
+            metrics.add("spin", perf_counter() - start)
+            yield
+
+    def pull(self, ts):
+        # lock must be held. ask the replicas which created the updates
+        # in ts that we haven't applied for exactly those updates.
+        origins = [id for id, n in ts.items()
+                   if id != self.id and n > self.ts.get(id, 0)]
+        if self.pulling or not origins:
+            return
+        self.pulling = True
+        self.start_pull(origins, self.ts, ts)
+
+    def start_pull(self, origins, since, until):
+        Thread(target=self.pull_from, args=(origins, since, until)).start()
+
+    def pull_from(self, origins, since, until):
+        try:
+            for origin in origins:
+                uri = self.membership.lookup(origin) or "PYRONAME:replica:%s" % origin
+                with ignore_disconnects(), ignore_status_errors():
+                    with Pyro4.Proxy(uri) as peer:
+                        log = peer.get_updates(since, until)
+                    if log and self.pulled(log, until):
+                        return
+        except Pyro4.errors.NamingError:
+            # the origin is gone, we'll have to wait for gossip
+            pass
+        finally:
+            self.pulling = False
+
+    def pulled(self, log, until):
+        # apply the raw updates we pulled. => whether we have all of until
+        with self.lock:
+            for e in self.receive(log):
+                self.sync_ts = vc.merge(self.sync_ts, e.ts)
+            self.need_reconstruct = True
+            self.apply_updates()
+            return vc.geq(self.ts, until)
+
+    def receive(self, log):
+        # lock must be held. buffer the raw entries we don't have yet,
+        # and return them.
+        entries = []
+        for u in log:
+            if (u[0], u[1]) in self.known_uids:
+                continue
+            e = Entry.from_raw(u)
+            self.latest = max(self.latest, e.time)
+            self.known_uids.add((e.id, e.node_id))
+            digest.add(self.digests, e)
+            self.buffer.append(e)
+            entries.append(e)
+        self.unsent += len(entries)
+        return entries
 
     def check_status(self):
-        if self.forced_offline or not self.is_online:
+        if self.forced_offline or not self.is_online or self.bootstrapping:
             raise RuntimeError("replica offline")
 
-    def add_update(self, op, prev, id=None):
+    def add_update(self, op, prev, id=None, deps=()):
         # op = some op object
         # prev = v.c. of causal dependency
+        # deps = ids of the updates it depends on, if any
         #
         # generate an update-id if necessary, otherwise we are given one from
         # the frontend in the case of a 2PC/forced update
+        #
+        # the update is stamped with a hybrid time: our clock, unless we
+        # know of a later update, so that it comes after the updates we
+        # have applied whatever our clocks say (see CRDTDB)
         id = id or generate_id()
         ts = prev.copy()
         new_sync_ts = vc.increment(self.sync_ts, self.id)
         ts[self.id] = new_sync_ts[self.id]
-        self.buffer.append(Entry(id, self.id, op, prev, ts, time()))
+        self.latest = max(self.clock(), self.latest + 1e-6)
+        e = Entry(id, self.id, op, prev, ts, self.latest, tuple(deps))
+        self.known_uids.add((e.id, e.node_id))
+        digest.add(self.digests, e)
+        self.buffer.append(e)
         # try to apply update immediately
         self.apply_updates()
         self.need_reconstruct = True
         self.sync_ts = new_sync_ts
+        self.unsent += 1
+        self.wake_gossip()
         return ts
 
+    def wake_gossip(self):
+        # there are new updates to apply and pass on, don't wait for the
+        # end of the period
+        self.wakeup.set()
+
     # exposed methods
 
     @Pyro4.expose
@@ -146,33 +509,158 @@ class Replica:
 
     @Pyro4.expose
     def status(self):
-        if self.forced_offline or not self.is_online:
-            return 'offline'
+        return self.load_report()["status"]
+
+    @Pyro4.expose
+    def load(self):
+        return self.load_report()
+
+    def load_report(self):
         # overloaded => frontend won't choose us for sending updates
         # or querying from, but we will still respond.
-        if random() <= 0.25:
-            return 'overloaded'
-        return 'online'
+        # score = how close we are to being overloaded, the frontend
+        # prefers replicas with lower scores. reconstructs don't hold
+        # the lock, but they still compete for the CPU.
+        load = {
+            "requests": self.requests - 1,  # not counting this one
+            "lock_wait": self.lock.wait,
+            "buffer": len(self.buffer),
+            "reconstructing": self.reconstructing,
+        }
+        load["score"] = max(load["requests"] / self.max_requests,
+                            load["lock_wait"] / self.max_lock_wait,
+                            load["buffer"] / self.max_buffer,
+                            0.5 * self.reconstructing)
+        load["status"] = 'online'
+        if load["score"] >= 1:
+            load["status"] = 'overloaded'
+        if self.forced_offline or not self.is_online or self.bootstrapping:
+            load["status"] = 'offline'
+        return load
+
+    @Pyro4.expose
+    def open_snapshot(self):
+        # => (id, ts) of a copy of our state and log, for a replica which
+        # is far behind to read in chunks with read_snapshot()
+        self.check_status()
+        now = time()
+        for sid, (_, last_read) in list(self.snapshots.items()):
+            if now - last_read > self.snapshot_timeout:
+                self.snapshots.pop(sid, None)
+        if len(self.snapshots) >= self.max_snapshots:
+            raise RuntimeError("too many snapshots")
+        with self.lock:
+            items = list(self.db.snapshot())
+            items.extend(("log", None, e) for e in self.log)
+            ts = self.ts
+        sid = generate_id()
+        self.snapshots[sid] = [items, now]
+        return sid, ts
+
+    @Pyro4.expose
+    def read_snapshot(self, sid, start, size):
+        # => (items, start of the next chunk or None). a chunk holds
+        # about size values; the reader asks for the next one when it's
+        # done with this one.
+        self.check_status()
+        snapshot = self.snapshots.get(sid)
+        if snapshot is None:
+            raise RuntimeError("unknown snapshot")
+        snapshot[1] = time()
+        items, chunk, n = snapshot[0], [], 0
+        while start < len(items) and n < size:
+            table, key, value = items[start]
+            if table == "log":
+                value = value.to_raw()
+            chunk.append((table, key, value))
+            n += len(value) if isinstance(value, dict) else 1
+            start += 1
+        return chunk, start if start < len(items) else None
+
+    @Pyro4.expose
+    def close_snapshot(self, sid):
+        self.snapshots.pop(sid, None)
+
+    @Pyro4.expose
+    def metrics(self):
+        # cheap enough to leave on; answered even when we're offline
+        with self.lock:
+            sizes = {
+                "log": len(self.log),
+                "buffer": len(self.buffer),
+                "executed_ids": len(self.executed_ids),
+                "known_uids": len(self.known_uids),
+                "tentative": len(self.tentative),
+            }
+        return dict(sizes, **{
+            "requests": self.requests - 1,
+            "online": int(self.load_report()["status"] == "online"),
+            "apply_seconds": self.apply_time.export(),
+            "reconstruct_seconds": self.reconstruct_time.export(),
+            "spin_wait_seconds": self.spin_wait.export(),
+            "spin_timeouts_total": self.spin_timeouts,
+            "lock_wait_seconds": self.lock.waits.export(),
+            "lock_hold_seconds": self.lock.holds.export(),
+            "gossip": {peer: dict(sent) for peer, sent in self.gossip_sent.items()},
+        })
+
+    @Pyro4.expose
+    def metrics_text(self):
+        # metrics() in the Prometheus text format
+        return metrics.prometheus([({"replica": self.id}, self.metrics())], "rated_replica_")
+
+    @Pyro4.expose
+    def start_profile(self, duration=10, mode="cpu"):
+        # sample the stacks of all our threads for duration seconds, see
+        # profiler.py. => False if a profile is already running
+        return profiler.start(duration, mode)
+
+    @Pyro4.expose
+    def get_profile(self):
+        return profiler.export()
 
     @Pyro4.expose
     def get_log(self):
         # used for testing
-        return self.ts, self.log
+        return self.ts, [e.to_raw() for e in self.log]
 
     @Pyro4.expose
     def get_state(self):
         # used for testing
-        return self.ts, {
+        return self.ts, serializer.plain({
             "movies": self.db.movies,
             "ratings": self.db.ratings,
             "tags": self.db.tags,
-        }
+        })
 
     @Pyro4.expose
     def get_timestamp(self):
         self.check_status()
         return self.sync_ts
 
+    @Pyro4.expose
+    def get_timestamps(self):
+        # timestamp of log + buffer, and timestamp of state
+        self.check_status()
+        return self.sync_ts, self.ts
+
+    @Pyro4.expose
+    def get_updates(self, since, until):
+        # updates which are in until but not in since; used by peers
+        # to pull the ones they are missing
+        self.check_status()
+        with self.lock:
+            return [e.to_raw() for e in chain(self.log, self.buffer)
+                    if vc.geq(until, e.ts) and not vc.geq(since, e.ts)]
+
+    @Pyro4.expose
+    def exchange_views(self, view):
+        # first step of a gossip exchange: merge the caller's view of the
+        # membership into ours, and return ours along with our timestamp
+        self.check_status()
+        self.membership.merge(view)
+        return self.sync_ts, self.membership.export()
+
     @Pyro4.expose
     def sync(self, log, ts):
         # called by other peers when they have updates to send to us
@@ -181,72 +669,107 @@ class Replica:
         self.check_status()
         with self.lock:
             self.sync_ts = vc.merge(self.sync_ts, ts)
-            self.buffer.extend(Entry.from_raw(u) for u in log)
+            if self.receive(log):
+                self.wake_gossip()
             self.has_new_gossip = True
 
     @Pyro4.expose
-    def list_movies(self, ts):
+    def get_digests(self, origins=None):
+        # digest per origin, or per sequence range of the given origins
         self.check_status()
-        with self.spin(ts):
-            data = {id: movie["name"] for id, movie in self.db.movies.items()}
-            return data, self.ts
+        with self.lock:
+            if origins is None:
+                return digest.origins(self.digests)
+            return digest.buckets(self.digests, origins)
 
     @Pyro4.expose
-    def search(self, name, genres, ts):
+    def list_movies(self, ts, bound=0):
         self.check_status()
-        with self.spin(ts):
-            results = {}
-            genres = set(genres)
-            for id, movie in self.db.movies.items():
-                if name in movie['name'] and genres.issubset(movie['genres']):
-                    results[id] = movie
-            return results, self.ts
+        with self.spin(ts, bound):
+            return self.movie_list(), self.ts
+
+    def movie_list(self):
+        return {id: movie["name"] for id, movie in self.db.movies.items()}
 
     @Pyro4.expose
-    def get_movie(self, movie_id, ts):
+    def search(self, name, genres, ts, bound=0):
         self.check_status()
-        with self.spin(ts):
-            if movie_id not in self.db.movies:
-                return None, self.ts
-            data = {}
-            data.update(self.db.movies[movie_id])
-
-            # compile tags
-            data["tags"] = set()
-            for tags in self.db.tags.values():
-                data["tags"].update(tags[movie_id])
-
-            # compile ratings
-            ratings = [r[movie_id] for r in self.db.ratings.values() if movie_id in r]
-            data["ratings"] = {
-                "avg": sum(ratings) / len(ratings) if ratings else None,
-                "min": min(ratings) if ratings else None,
-                "max": max(ratings) if ratings else None,
-                "len": len(ratings),
-            }
-            return data, self.ts
+        with self.spin(ts, bound):
+            return self.search_movies(name, genres), self.ts
+
+    def search_movies(self, name, genres):
+        results = {}
+        genres = set(genres)
+        for id, movie in self.db.movies.items():
+            if name in movie['name'] and genres.issubset(movie['genres']):
+                results[id] = movie
+        return results
 
     @Pyro4.expose
-    def get(self, user_id, ts):
+    def get_movie(self, movie_id, ts, bound=0):
         self.check_status()
-        with self.spin(ts):
-            data = {
-                "ratings": self.db.ratings[user_id],
-                "tags":    self.db.tags[user_id],
-            }
-            return data, self.ts
+        with self.spin(ts, bound):
+            return self.movie_data(movie_id), self.ts
+
+    def movie_data(self, movie_id):
+        if movie_id not in self.db.movies:
+            return None
+        data = {}
+        data.update(self.db.movies[movie_id])
+
+        # compile tags
+        data["tags"] = set()
+        for tags in self.db.tags.values():
+            data["tags"].update(tags[movie_id])
+
+        # compile ratings
+        ratings = [r[movie_id] for r in self.db.ratings.values() if movie_id in r]
+        data["ratings"] = {
+            "avg": sum(ratings) / len(ratings) if ratings else None,
+            "min": min(ratings) if ratings else None,
+            "max": max(ratings) if ratings else None,
+            "len": len(ratings),
+        }
+        return data
 
     @Pyro4.expose
-    def update(self, raw, ts):
+    def get(self, user_id, ts, bound=0):
         self.check_status()
-        with self.lock:
-            return self.add_update(op_from_raw(raw), ts)
+        with self.spin(ts, bound):
+            return self.user_data(user_id), self.ts
+
+    def user_data(self, user_id):
+        return {
+            "ratings": dict(self.db.ratings[user_id]),
+            "tags":    dict(self.db.tags[user_id]),
+        }
+
+    @contextmanager
+    def causal_past(self, ts, deps=()):
+        # lock held inside. CRDT replicas have to stamp an update after
+        # the ones it depends on, so they wait until they've applied
+        # them, like reads do
+        if not self.crdt:
+            with self.lock:
+                yield
+            return
+        with self.spin(ts, deps=deps):
+            yield
+
+    @Pyro4.expose
+    def update(self, raw, ts, id=None, deps=()):
+        self.check_status()
+        with self.causal_past(ts, deps):
+            return self.add_update(op_from_raw(raw), ts, id, deps)
 
     @Pyro4.expose
     def commit_update(self, id):
         self.check_status()
-        with self.lock:
-            update, ts = self.tentative.pop(id)
+        # only popped once we're done waiting, so that a commit which
+        # timed out can be retried
+        update, ts = self.tentative[id]
+        with self.causal_past(ts):
+            self.tentative.pop(id)
             return self.add_update(update, ts, id)
 
     @Pyro4.expose
@@ -259,17 +782,20 @@ class Replica:
 
 
 if __name__ == '__main__':
-    # generate id if necessary
+    serializer.configure()
+    # python replica.py [id] [--crdt]; generate id if necessary
+    args = [arg for arg in sys.argv[1:] if arg != "--crdt"]
     id = generate_id(5)
-    if len(sys.argv) == 2 and sys.argv[1]:
-        id = sys.argv[1]
-    r = Replica(id)
+    if len(args) == 1 and args[0]:
+        id = args[0]
+    r = Replica(id, crdt="--crdt" in sys.argv[1:])
 
-    with Pyro4.Daemon() as daemon:
+    with metrics.Daemon() as daemon:
         uri = daemon.register(r, objectId=r.id)
+        r.membership.uri = str(uri)
         with Pyro4.locateNS() as ns:
             ns.register("replica:%s" % r.id, uri, metadata={"replica"})
 
-        unregister_at_exit("replica:%s" % r.id)
+        unregister_at_exit("replica:%s" % r.id, r.shutdown)
         Thread(target=r.gossip).start()
         daemon.requestLoop()
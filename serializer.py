@@ -0,0 +1,30 @@
+import os
+import Pyro4
+
+
+# the serializer used for all our RPCs, one of Pyro4's: marshal (the
+# default; fast, and keeps sets, tuples and non-string keys as they are),
+# serpent, msgpack or pickle. every process of the cluster must use the
+# same one. not json, which would turn the sets (tags) into lists and the
+# int keys (ratings, vector clocks) into strings:
+#
+#   $ RATED_SERIALIZER=serpent python replica.py
+#
+# marshal only takes plain builtin types, so anything sent over the
+# wire goes through to_raw() / plain() first.
+
+NAME = os.environ.get("RATED_SERIALIZER", "marshal")
+
+
+def configure():
+    if NAME == "json":
+        raise ValueError("RATED_SERIALIZER=json can't carry our sets and int keys")
+    Pyro4.config.SERIALIZER = NAME
+    Pyro4.config.SERIALIZERS_ACCEPTED.add(NAME)
+
+
+def plain(data):
+    # => data with the defaultdicts (and dict subclasses) turned into dicts
+    if isinstance(data, dict):
+        return {key: plain(value) for key, value in data.items()}
+    return data
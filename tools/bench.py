@@ -0,0 +1,241 @@
+import json
+import os
+import platform
+import sys
+from os.path import dirname, join
+from random import Random
+from time import perf_counter
+sys.path.insert(0, join(dirname(__file__), ".."))
+
+import vector_clock as vc
+from models import AddTag, DB, Entry, Update
+from replica import Replica
+from utils import apply_updates, sort_buffer
+
+# micro-benchmarks of the hot paths, without a name server or cluster:
+#
+#   $ python tools/bench.py [name prefix ...]          compare with the baseline
+#   $ python tools/bench.py --save [name prefix ...]   (re)write the baseline
+#
+# each benchmark reports the best of several runs (microseconds per call),
+# on seeded random data. the baseline is tools/bench_baseline.json, and we
+# exit with 1 when a benchmark got more than its tolerance slower than it.
+# the baseline is scaled by how much slower a fixed reference loop runs
+# than when it was saved, so that a busier or throttled machine doesn't
+# look like a regression; still, baselines are only comparable on the
+# same machine and Python.
+
+BASELINE = join(dirname(__file__), "bench_baseline.json")
+TOLERANCE = 0.5
+# the ones which only get a few runs of a large batch are noisier
+TOLERANCES = {"apply_updates.": 1.0, "reconstruct/": 1.0, "DB.from_data": 1.0}
+REPEAT = 9
+RETRIES = 2  # measure a benchmark again when it looks slower, keep the best
+
+random = Random(0)
+data = DB.from_data()
+users, movies = sorted(data.ratings), sorted(data.movies)
+
+
+def best(f, setup=lambda: None, repeat=REPEAT, min_time=0.05):
+    # => seconds per call of f(setup()), calling it often enough that
+    # each run takes at least min_time; setup isn't timed
+    n, runs = 1, []
+    while True:
+        args = [setup() for _ in range(n)]
+        start = perf_counter()
+        for arg in args:
+            f(arg)
+        elapsed = perf_counter() - start
+        if elapsed >= min_time or n >= 1000000:
+            break
+        n *= 2 if elapsed else 10
+    runs.append(elapsed / n)
+    for _ in range(repeat - 1):
+        args = [setup() for _ in range(n)]
+        start = perf_counter()
+        for arg in args:
+            f(arg)
+        runs.append((perf_counter() - start) / n)
+    return min(runs)
+
+
+def tolerance(name):
+    for prefix, tolerance in TOLERANCES.items():
+        if name.startswith(prefix):
+            return tolerance
+    return TOLERANCE
+
+
+def calibrate():
+    # => seconds per run of a fixed mix of the dict and set work the
+    # benchmarks do
+    def reference(_):
+        d = {}
+        for i in range(2000):
+            d[i % 300] = d.get(i % 300, 0) + i
+        return sorted(set(d.values()))
+    return best(reference, repeat=15, min_time=0.2)
+
+
+def clock(nodes, spread=1000):
+    return {"n%d" % i: random.randrange(spread) for i in range(nodes)}
+
+
+def random_op():
+    if random.random() < 0.8:
+        return Update(random.choice(users), random.choice(movies), random.randrange(1, 11) / 2)
+    return AddTag(random.choice(users), random.choice(movies), {random.choice(["funny", "dark", "slow"])})
+
+
+def causal_log(n, nodes=5):
+    # n updates from `nodes` replicas, each depending on everything its
+    # replica had seen: its own earlier updates, and sometimes the others'
+    seen = {"n%d" % i: {} for i in range(nodes)}
+    entries = []
+    for i in range(n):
+        node = "n%d" % random.randrange(nodes)
+        if random.random() < 0.3:
+            other = entries[random.randrange(len(entries))] if entries else None
+            if other is not None:
+                seen[node] = vc.merge(seen[node], other.ts)
+        prev = seen[node]
+        seen[node] = vc.increment(prev, node)
+        entries.append(Entry("u%d" % i, node, random_op(), prev, seen[node], float(i)))
+    return entries
+
+
+def scaled(db, scale):
+    # the dataset with scale times as many users and movies (a sample of
+    # them for scale < 1, copies with other ids for scale > 1)
+    new = DB()
+    for i in range(int(len(movies) * scale)):
+        movie = movies[i % len(movies)]
+        new_movie = movie if i < len(movies) else "%s.%d" % (movie, i // len(movies))
+        new.movies[new_movie] = db.movies[movie]
+    n = int(len(users) * scale)
+    for i in range(n):
+        user = users[i % len(users)]
+        new_user = user + (i // len(users)) * 100000
+        new.ratings[new_user] = dict(db.ratings[user])
+        for movie_id, tags in db.tags.get(user, {}).items():
+            new.tags[new_user][movie_id] = set(tags)
+    return new
+
+
+def bench_vector_clock():
+    for nodes in (3, 10, 50, 200):
+        v1, v2 = clock(nodes), clock(nodes)
+        yield "vector_clock.merge/%d" % nodes, lambda: best(lambda _: vc.merge(v1, v2))
+        yield "vector_clock.geq/%d" % nodes, lambda: best(lambda _: vc.geq(v1, v2))
+        yield "vector_clock.missing/%d" % nodes, lambda: best(lambda _: vc.missing(v1, v2))
+        yield "vector_clock.is_concurrent/%d" % nodes, lambda: best(lambda _: vc.is_concurrent(v1, v2))
+
+
+def bench_apply_updates():
+    def run(buffer):
+        apply_updates({}, DB(), set(), set(), [], buffer)
+
+    for n in (1000, 5000):
+        log = causal_log(n)
+        in_order = list(log)
+        sort_buffer(in_order)
+        shuffled = list(log)
+        random.shuffle(shuffled)
+        yield "apply_updates.in_order/%d" % n, lambda: best(run, lambda: list(in_order), min_time=0)
+        yield "apply_updates.shuffled/%d" % n, lambda: best(run, lambda: list(shuffled), repeat=3, min_time=0)
+    # worst case: every pass over the buffer only applies its last update
+    log = causal_log(1000, nodes=1)
+    yield "apply_updates.reversed/1000", lambda: best(run, lambda: log[::-1], min_time=0)
+
+
+def bench_reconstruct(replica):
+    for n in (1000, 5000, 20000):
+        log = causal_log(n)
+        sort_buffer(log)
+
+        def setup():
+            replica.log, replica.buffer = list(log), []
+        yield "reconstruct/%d" % n, lambda: best(lambda _: replica.reconstruct(), setup, min_time=0)
+
+
+def bench_db():
+    yield "DB.from_data", lambda: best(lambda _: DB.from_data(), min_time=0.2)
+
+
+def bench_reads(replica):
+    for scale in (0.25, 1, 4, 16):
+        replica.db = scaled(data, scale)
+        movie_ids = [random.choice(movies) for _ in range(100)]
+        yield "get_movie/x%s" % scale, lambda: best(lambda _: [replica.movie_data(m) for m in movie_ids]) / len(movie_ids)
+        yield "search.name/x%s" % scale, lambda: best(lambda _: replica.search_movies("The", []))
+        yield "search.genres/x%s" % scale, lambda: best(lambda _: replica.search_movies("", ["Comedy", "Drama"]))
+
+
+def machine():
+    return {"python": platform.python_version(), "platform": platform.platform(),
+            "cpus": os.cpu_count()}
+
+
+def run(prefixes):
+    # => (name, measure) of the benchmarks whose names start with one of
+    # the prefixes, or of all of them; measure() => seconds
+    replica = Replica("bench")
+    suites = [bench_vector_clock(), bench_apply_updates(), bench_reconstruct(replica),
+              bench_db(), bench_reads(replica)]
+    for suite in suites:
+        for name, measure in suite:
+            if not prefixes or name.startswith(tuple(prefixes)):
+                yield name, measure
+
+
+def main(args):
+    save = "--save" in args
+    prefixes = [arg for arg in args if arg != "--save"]
+    baseline = {"machine": None, "results": {}}
+    if os.path.exists(BASELINE):
+        with open(BASELINE) as f:
+            baseline = json.load(f)
+    if not save and baseline["machine"] not in (None, machine()):
+        print("baseline from another machine: %s" % baseline["machine"])
+    calibration = calibrate()
+    speed = calibration / baseline.get("calibration", calibration)
+    if not save:
+        print("machine speed: the baseline scaled by %.2f" % speed)
+    old = baseline["results"]
+    results, slower = {}, []
+    print("%-32s %12s %12s %8s" % ("benchmark", "us", "baseline", "change"))
+    for name, measure in run(prefixes):
+        seconds = measure()
+        if name in old and not save:
+            # a slow run is more likely to be noise than a regression
+            for _ in range(RETRIES):
+                if seconds / (old[name] * speed) - 1 <= tolerance(name):
+                    break
+                seconds = min(seconds, measure())
+        results[name] = seconds
+        line = "%-32s %12.3f" % (name, seconds * 1e6)
+        if name in old:
+            expected = old[name] * speed
+            change = seconds / expected - 1
+            line += " %12.3f %+7.0f%%" % (expected * 1e6, change * 100)
+            if change > tolerance(name):
+                slower.append(name)
+                line += "  slower"
+        print(line)
+    if save:
+        # the results we keep, as if measured at today's speed
+        old = {name: seconds * speed for name, seconds in old.items()}
+        old.update(results)
+        with open(BASELINE, "w") as f:
+            json.dump({"machine": machine(), "calibration": calibration,
+                       "results": dict(sorted(old.items()))}, f, indent=2)
+            f.write("\n")
+    elif slower:
+        print("\033[31mFAIL\033[0m")
+        print("%d benchmarks slower than the baseline by more than their tolerance" % len(slower))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,57 @@
+import sys
+from os.path import dirname, join
+from random import choice, random
+from time import perf_counter
+sys.path.insert(0, join(dirname(__file__), ".."))
+
+from Pyro4.errors import SerializeError
+from Pyro4.util import get_serializer
+from models import AddTag, DB, Entry, Update
+from serializer import plain
+from utils import generate_id
+
+# bytes and encode/decode time of our RPC messages with each of Pyro4's
+# serializers:
+#
+#   $ python tools/bench_serializers.py [serializer ...]
+
+db = DB.from_data()
+users, movies = list(db.ratings), list(db.movies)
+nodes = [generate_id(5) for _ in range(5)]
+
+
+def entry(i):
+    op = choice([Update(choice(users), choice(movies), 4.5),
+                 AddTag(choice(users), choice(movies), {"funny", "dark"})])
+    ts = {node: i + n for n, node in enumerate(nodes)}
+    return Entry(generate_id(), choice(nodes), op, ts, ts, random()).to_raw()
+
+
+messages = {
+    "sync (500 entries)": ([entry(i) for i in range(500)], {node: 500 for node in nodes}),
+    "get_state": plain({"movies": db.movies, "ratings": db.ratings, "tags": db.tags}),
+    "list_movies": ({id: movie["name"] for id, movie in db.movies.items()}, {}),
+    "get": ({"ratings": dict(db.ratings[users[0]]), "tags": dict(db.tags[users[0]])}, {}),
+}
+
+
+def measure(f, arg, seconds=0.2):
+    n, start = 0, perf_counter()
+    while perf_counter() - start < seconds:
+        result = f(arg)
+        n += 1
+    return (perf_counter() - start) / n, result
+
+
+names = sys.argv[1:] or ["marshal", "serpent", "msgpack", "pickle"]
+print("%-20s %-8s %10s %12s %12s" % ("message", "format", "bytes", "encode ms", "decode ms"))
+for message, data in messages.items():
+    for name in names:
+        try:
+            s = get_serializer(name)
+            encode, (raw, _) = measure(s.serializeData, data)
+            decode, _ = measure(s.deserializeData, raw)
+        except (SerializeError, TypeError, ValueError) as exc:
+            print("%-20s %-8s %s" % (message, name, "n/a (%s)" % exc))
+            continue
+        print("%-20s %-8s %10d %12.3f %12.3f" % (message, name, len(raw), encode * 1000, decode * 1000))
@@ -0,0 +1,37 @@
+import asyncio
+import sys
+from os.path import dirname, join
+from time import perf_counter
+sys.path.insert(0, join(dirname(__file__), ".."))
+
+from aio_client import AsyncFrontend
+
+# ratings on user 1 pipelined from one process (see tools/load.py for a thread
+# per session instead), over a number of sessions (connections to the frontend):
+#
+#   $ python tools/bombard_async.py [ratings] [in flight] [sessions]
+
+
+async def rate(frontend, value):
+    while True:
+        try:
+            return await frontend.add_rating(1, '1', value)
+        except RuntimeError:
+            # no replica available right now
+            await asyncio.sleep(0.05)
+
+
+async def session(n, in_flight):
+    async with await AsyncFrontend.connect(in_flight) as frontend:
+        await asyncio.gather(*(rate(frontend, i % 5) for i in range(n)))
+
+
+async def main(n, in_flight, sessions):
+    start = perf_counter()
+    await asyncio.gather(*(session(n // sessions, in_flight) for _ in range(sessions)))
+    elapsed = perf_counter() - start
+    print("%d ratings in %.2fs (%.0f/s)" % (n, elapsed, n / elapsed))
+
+
+args = [int(arg) for arg in sys.argv[1:]]
+asyncio.run(main(*args + [100, 64, 1][len(args):]))
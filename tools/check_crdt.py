@@ -0,0 +1,98 @@
+import sys
+from os.path import dirname, join
+from random import choice, random, randrange, sample, shuffle, seed
+sys.path.insert(0, join(dirname(__file__), ".."))
+
+from models import AddTag, CRDTDB, DB, Delete, Entry, RemoveTag, Update, UpdateMovie
+import vector_clock as vc
+from utils import apply_updates, generate_id, sort_buffer
+
+# apply random updates to a CRDTDB in random orders and batches, and check
+# that we end up where replaying them sorted by (time, id) gets us, like
+# reconstruct does. the updates have causal dependencies, and the clocks
+# of the replicas are skewed.
+
+nodes = ["A", "B", "C"]
+users = range(5)
+movies = ["m1", "m2", "m3", "m4"]
+tags = ["x", "y", "z"]
+
+
+def random_op():
+    user_id, movie_id = choice(users), choice(movies)
+    return choice([
+        lambda: Update(user_id, movie_id, randrange(1, 6)),
+        lambda: Delete(user_id, movie_id),
+        lambda: AddTag(user_id, movie_id, sample(tags, randrange(1, 3))),
+        lambda: RemoveTag(user_id, movie_id, sample(tags, randrange(1, 3))),
+        lambda: UpdateMovie(movie_id, {"name": generate_id(3), "genres": []}),
+    ])()
+
+
+def random_entries(n):
+    # sessions send updates to random replicas, each one depending on the
+    # session's earlier updates, and start over now and then. replicas
+    # stamp an update with their clock, pushed past the times of the
+    # updates it depends on, like Replica.add_update does.
+    entries, seqs = [], dict.fromkeys(nodes, 0)
+    skew = {node_id: random() * 50 for node_id in nodes}
+    sessions = [({}, 0) for _ in range(3)]  # (ts, latest time)
+    for i in range(n):
+        session = randrange(len(sessions))
+        prev, latest = sessions[session] if random() < 0.9 else ({}, 0)
+        op, id = random_op(), generate_id()
+        # forced updates are added on a majority of the replicas
+        copies = nodes if isinstance(op, UpdateMovie) else [choice(nodes)]
+        ts, t = prev, latest
+        for node_id in copies:
+            seqs[node_id] += 1
+            e = Entry(id, node_id, op, prev, dict(prev, **{node_id: seqs[node_id]}),
+                      max(i + skew[node_id] + random(), latest + 1e-6))
+            entries.append(e)
+            ts, t = vc.merge(ts, e.ts), max(t, e.time)
+        sessions[session] = (ts, t)
+    return entries
+
+
+def overwrite_on_slow_clock():
+    # X's clock is ahead of Y's, and Y overwrites X's rating
+    a = Entry("a", "X", Update(0, "m1", 3.0), {}, {"X": 1}, 10)
+    b = Entry("b", "Y", Update(0, "m1", 5.0), {"X": 1}, {"X": 1, "Y": 1}, max(5, a.time + 1e-6))
+    return [a, b]
+
+
+def reconstruct(entries):
+    db, buffer = DB(), list(entries)
+    sort_buffer(buffer)
+    _, buffer = apply_updates({}, db, set(), set(), [], buffer)
+    assert not buffer
+    return db
+
+
+def crdt(entries):
+    # any order, in batches of any size. updates wait in the buffer
+    # until the ones they depend on are in
+    db, ids, uids, entries = CRDTDB(), set(), set(), list(entries)
+    ts, buffer = {}, []
+    shuffle(entries)
+    while entries:
+        n = randrange(1, len(entries) + 1)
+        ts, buffer = apply_updates(ts, db, ids, uids, [], buffer + entries[:n])
+        entries = entries[n:]
+    assert not buffer
+    return db
+
+
+def state(db):
+    return (db.movies,
+            {u: dict(r) for u, r in db.ratings.items()},
+            {u: {m: set(t) for m, t in data.items()} for u, data in db.tags.items()})
+
+
+seed(int(sys.argv[1]) if len(sys.argv) > 1 else None)
+cases = [overwrite_on_slow_clock()] + [random_entries(randrange(1, 200)) for _ in range(200)]
+for entries in cases:
+    if state(crdt(entries)) != state(reconstruct(entries)):
+        print("\033[31mFAIL\033[0m")
+        print("CRDT state differs from the reconstructed state")
+        sys.exit(1)
@@ -8,7 +8,8 @@ for u in r:
     print(json.dumps({
         "id":   u[0],
         "uid":  u[1],
-        "prev": u[-3],
-        "ts":   u[-2],
-        "time": u[-1],
+        "prev": u[3],
+        "ts":   u[4],
+        "time": u[5],
+        "deps": u[6] if len(u) > 6 else [],
         }, sort_keys=True))
@@ -0,0 +1,46 @@
+import sys
+from os.path import dirname, join
+sys.path.insert(0, join(dirname(__file__), ".."))
+
+import Pyro4
+from Pyro4.errors import NamingError
+
+import serializer
+
+# print the frontends' latency percentiles per operation, and the stages
+# of their slowest recent operations:
+#
+#   $ python tools/latency.py [number of traces]
+
+
+def frontends(ns):
+    uris = dict(ns.list(metadata_all={"frontend"}))
+    try:
+        uris["frontend"] = ns.lookup("frontend")
+    except NamingError:
+        pass
+    return uris
+
+
+def ms(seconds):
+    return "%8.1f" % (seconds * 1000)
+
+
+serializer.configure()
+n = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+with Pyro4.locateNS() as ns:
+    uris = frontends(ns)
+for name, uri in sorted(uris.items()):
+    with Pyro4.Proxy(uri) as frontend:
+        latency, traces = frontend.latency(), frontend.slow_traces(n)
+    print(name)
+    print("  %-14s %8s %8s %8s %8s %8s" % ("operation", "count", "mean", "p50", "p99", "p999"))
+    for op, stats in sorted(latency.items()):
+        print("  %-14s %8d %s %s %s %s  ms" % (
+            op, stats["count"], ms(stats["mean"]), ms(stats["p50"]),
+            ms(stats["p99"]), ms(stats["p999"])))
+    for trace in traces:
+        print("\n  %s %s %s ms" % (trace["operation"], trace["id"], ms(trace["seconds"]).strip()))
+        for stage, seconds in sorted(trace["stages"].items(), key=lambda s: -s[1]):
+            print("    %-30s %s ms" % (stage, ms(seconds)))
+    print()
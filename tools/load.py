@@ -0,0 +1,287 @@
+import json
+import sys
+import threading
+from collections import Counter, defaultdict
+from itertools import accumulate, count
+from os.path import dirname, join
+from queue import Queue
+from random import Random
+from time import perf_counter, sleep
+sys.path.insert(0, join(dirname(__file__), ".."))
+
+import Pyro4
+from Pyro4.errors import CommunicationError
+
+import serializer
+from client import connect_frontend
+from metrics import Histogram, LATENCY
+from models import AddTag, DB, Delete, RemoveTag, Update
+
+# generate load on the cluster and report throughput and latency per
+# operation:
+#
+#   $ python tools/load.py [--mix get_user_data=30,get_movie=30,add_rating=30,add_movie=10]
+#         [--ops 1000 | --duration seconds] [--concurrency 8] [--rate ops/s]
+#         [--zipf 1.1] [--seed 0] [--retry] [--replica id] [--quiet] [--json file]
+#
+# users, movies and tags are drawn from data/*.csv, the popular ones
+# (by number of ratings, or uses for tags) more often: the i-th most
+# popular with a probability proportional to 1 / i ** zipf (0 => uniform).
+#
+# concurrency = number of sessions, each one a thread with its own
+# connection to a frontend. without --rate they send their next request
+# when they get a reply (closed loop). with --rate requests are due at
+# that rate overall whether or not the cluster keeps up (open loop), and
+# their latency counts from when they were due, so that queueing shows.
+#
+# --retry => retry requests which fail because no replica could serve
+# them (until they succeed), instead of counting them as errors.
+# --replica => send the updates straight to that replica, each session
+# with its own causal timestamp, like a frontend would (writes only).
+
+OPERATIONS = ("get_user_data", "get_movie", "search", "list_movies", "add_rating",
+              "delete_rating", "add_tag", "remove_tag", "add_movie")
+WRITES = {"add_rating": Update, "delete_rating": Delete, "add_tag": AddTag, "remove_tag": RemoveTag}
+GENRES = ["Action", "Comedy", "Drama", "Thriller", "Romance", "Sci-Fi"]
+
+
+class Zipf:
+    # draws the i-th item with a probability proportional to 1 / i ** s
+    def __init__(self, items, s):
+        self.items = items
+        self.weights = list(accumulate(1 / k ** s for k in range(1, len(items) + 1)))
+
+    def draw(self, random):
+        return random.choices(self.items, cum_weights=self.weights)[0]
+
+
+class Keys:
+    def __init__(self, s):
+        db = DB.from_data()
+        ratings = Counter(movie for user_ratings in db.ratings.values() for movie in user_ratings)
+        tags = Counter(tag for user_tags in db.tags.values()
+                       for movie_tags in user_tags.values() for tag in movie_tags)
+        self.users = Zipf(sorted(db.ratings, key=lambda user: -len(db.ratings[user])), s)
+        self.movies = Zipf(sorted(db.movies, key=lambda movie: -ratings[movie]), s)
+        self.tags = Zipf([tag for tag, _ in tags.most_common()], s)
+        self.names = {id: movie["name"] for id, movie in db.movies.items()}
+
+    def args(self, name, random):
+        # => arguments for a call of operation name
+        if name == "get_user_data":
+            return self.users.draw(random),
+        if name == "get_movie":
+            return self.movies.draw(random),
+        if name == "search":
+            return self.names[self.movies.draw(random)].split()[0], []
+        if name == "list_movies":
+            return ()
+        if name == "add_rating":
+            return self.users.draw(random), self.movies.draw(random), random.randrange(1, 11) / 2
+        if name == "delete_rating":
+            return self.users.draw(random), self.movies.draw(random)
+        if name in ("add_tag", "remove_tag"):
+            return self.users.draw(random), self.movies.draw(random), [self.tags.draw(random)]
+        if name == "add_movie":
+            return "Load test %d" % random.randrange(10 ** 6), random.sample(GENRES, 2)
+        raise ValueError("unknown operation %s" % name)
+
+
+class Session:
+    # a connection to a frontend, or to a replica with --replica
+    def __init__(self, replica=None):
+        self.replica = None
+        if replica is not None:
+            with Pyro4.locateNS() as ns:
+                self.replica = Pyro4.Proxy(ns.lookup("replica:%s" % replica))
+            self.ts = {}
+        else:
+            self.frontend = connect_frontend()
+
+    def call(self, name, args):
+        if self.replica is None:
+            return getattr(self.frontend, name)(*args)
+        if name not in WRITES:
+            raise ValueError("only updates can be sent to a replica")
+        self.ts = self.replica.update(WRITES[name](*args).to_raw(), self.ts)
+
+
+class Load:
+    def __init__(self, mix, keys, concurrency, ops=None, duration=None, rate=None,
+                 seed=0, retry=False, replica=None):
+        self.names = list(mix)
+        self.weights = list(accumulate(mix.values()))
+        self.keys = keys
+        self.concurrency = concurrency
+        self.ops = ops
+        self.duration = duration
+        self.rate = rate
+        self.seed = seed
+        self.retry = retry
+        self.replica = replica
+        self.lock = threading.Lock()
+        self.latency = defaultdict(lambda: Histogram(LATENCY))
+        self.errors = Counter()
+        self.retries = Counter()
+        self.max = Counter()
+        self.issued = count()
+        self.start = None
+
+    def next_op(self, random):
+        # => (operation, args), None once we're done
+        if self.ops is not None and next(self.issued) >= self.ops:
+            return None
+        if self.duration is not None and perf_counter() - self.start >= self.duration:
+            return None
+        name = random.choices(self.names, cum_weights=self.weights)[0]
+        return name, self.keys.args(name, random)
+
+    def execute(self, session, name, args, due):
+        while True:
+            try:
+                session.call(name, args)
+                error = None
+            except RuntimeError as exc:
+                if self.retry:
+                    with self.lock:
+                        self.retries[name] += 1
+                    sleep(0.01)
+                    continue
+                error = exc
+            except CommunicationError as exc:
+                error = exc
+            break
+        seconds = perf_counter() - due
+        with self.lock:
+            if error is None:
+                self.latency[name].observe(seconds)
+                self.max[name] = max(self.max[name], seconds)
+            else:
+                self.errors[name] += 1
+
+    def closed_loop(self, i):
+        random, session = Random(self.seed + i), Session(self.replica)
+        while True:
+            op = self.next_op(random)
+            if op is None:
+                return
+            self.execute(session, *op, perf_counter())
+
+    def open_loop(self, due):
+        session = Session(self.replica)
+        while True:
+            item = due.get()
+            if item is None:
+                return
+            self.execute(session, *item)
+
+    def schedule(self, due):
+        # requests at exponentially distributed intervals, at self.rate
+        random, t = Random(self.seed), self.start
+        while True:
+            op = self.next_op(random)
+            if op is None:
+                break
+            t += random.expovariate(self.rate)
+            sleep(max(0, t - perf_counter()))
+            due.put(op + (t,))
+        for _ in range(self.concurrency):
+            due.put(None)
+
+    def run(self):
+        # => seconds it took
+        self.start = perf_counter()
+        if self.rate is None:
+            threads = [threading.Thread(target=self.closed_loop, args=(i,))
+                       for i in range(self.concurrency)]
+        else:
+            due = Queue()
+            threads = [threading.Thread(target=self.open_loop, args=(due,))
+                       for i in range(self.concurrency)]
+            threads.append(threading.Thread(target=self.schedule, args=(due,)))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return perf_counter() - self.start
+
+    def report(self, seconds):
+        # => {operation: {"count", "errors", "retries", "throughput", "p50",
+        # "p90", "p99", "p999", "max"}}, with an "all" total
+        total = Histogram(LATENCY)
+        results = {}
+        for name in self.names:
+            h = self.latency[name]
+            total.counts = [a + b for a, b in zip(total.counts, h.counts)]
+            total.count += h.count
+            total.sum += h.sum
+            results[name] = self.stats(h, seconds, self.errors[name], self.retries[name], self.max[name])
+        results["all"] = self.stats(total, seconds, sum(self.errors.values()),
+                                    sum(self.retries.values()), max(self.max.values(), default=0))
+        return results
+
+    @staticmethod
+    def stats(h, seconds, errors, retries, slowest):
+        stats = {"count": h.count, "errors": errors, "retries": retries,
+                 "throughput": h.count / seconds, "max": slowest}
+        for q, key in ((0.5, "p50"), (0.9, "p90"), (0.99, "p99"), (0.999, "p999")):
+            # estimated within a bucket, which may go past the slowest
+            stats[key] = h.quantile(q) and min(h.quantile(q), slowest)
+        return stats
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        if name not in OPERATIONS:
+            sys.exit("unknown operation %s, one of %s" % (name, ", ".join(OPERATIONS)))
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def print_report(results, seconds):
+    def ms(seconds):
+        return "%8s" % ("-" if seconds is None else "%.1f" % (seconds * 1000))
+
+    print("%-14s %7s %7s %7s %9s %8s %8s %8s %8s %8s" % (
+        "operation", "count", "errors", "retries", "ops/s", "p50", "p90", "p99", "p999", "max"))
+    for name, stats in results.items():
+        print("%-14s %7d %7d %7d %9.1f %s %s %s %s %s" % (
+            name, stats["count"], stats["errors"], stats["retries"], stats["throughput"],
+            ms(stats["p50"]), ms(stats["p90"]), ms(stats["p99"]), ms(stats["p999"]),
+            ms(stats["max"] if stats["count"] else None)))
+    print("%.1fs, latencies in ms" % seconds)
+
+
+def main(args):
+    options = {"mix": "get_user_data=30,get_movie=30,add_rating=30,add_movie=10",
+               "ops": None, "duration": None, "concurrency": "8", "rate": None,
+               "zipf": "1.1", "seed": "0", "replica": None, "json": None}
+    flags = {"--retry", "--quiet"}
+    retry, quiet = "--retry" in args, "--quiet" in args
+    args = [arg for arg in args if arg not in flags]
+    for name, value in zip(args[::2], args[1::2]):
+        if not name.startswith("--") or name[2:] not in options:
+            sys.exit("unknown option %s" % name)
+        options[name[2:]] = value
+    if options["ops"] is None and options["duration"] is None:
+        options["ops"] = "1000"
+    load = Load(parse_mix(options["mix"]), Keys(float(options["zipf"])),
+                int(options["concurrency"]),
+                ops=None if options["ops"] is None else int(options["ops"]),
+                duration=None if options["duration"] is None else float(options["duration"]),
+                rate=None if options["rate"] is None else float(options["rate"]),
+                seed=int(options["seed"]), retry=retry, replica=options["replica"])
+    seconds = load.run()
+    results = load.report(seconds)
+    if not quiet:
+        print_report(results, seconds)
+    if options["json"]:
+        with open(options["json"], "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    serializer.configure()
+    main(sys.argv[1:])
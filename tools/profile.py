@@ -0,0 +1,33 @@
+import sys
+import time
+from os.path import dirname, join
+sys.path.insert(0, join(dirname(__file__), ".."))
+
+import Pyro4
+
+import serializer
+
+# profile a live replica or frontend, and write its collapsed stacks to a
+# file which flamegraph.pl or speedscope can read:
+#
+#   $ python tools/profile.py <replica id | frontend> [seconds] [cpu | wall]
+
+
+serializer.configure()
+name = sys.argv[1]
+duration = float(sys.argv[2]) if len(sys.argv) > 2 else 10
+mode = sys.argv[3] if len(sys.argv) > 3 else "cpu"
+with Pyro4.locateNS() as ns:
+    uri = ns.lookup(name if name.startswith("frontend") else "replica:%s" % name)
+with Pyro4.Proxy(uri) as target:
+    if not target.start_profile(duration, mode):
+        print("a profile is already running, waiting for it")
+    while True:
+        time.sleep(min(duration, 1))
+        profile = target.get_profile()
+        if not profile["running"]:
+            break
+path = "profile.%s.%s" % (name, profile["mode"])
+with open(path, "w") as f:
+    f.write(profile["stacks"])
+print("%d samples over %.1fs => %s" % (profile["samples"], profile["seconds"], path))
@@ -0,0 +1,225 @@
+import gzip
+import json
+import marshal
+import sys
+import threading
+import zlib
+from collections import Counter, defaultdict
+from os.path import dirname, join
+from time import perf_counter, sleep
+sys.path.insert(0, join(dirname(__file__), ".."))
+
+from Pyro4.errors import CommunicationError
+
+import serializer
+from client import connect_frontend
+from metrics import Histogram, LATENCY
+
+# replay the traffic a frontend captured (python frontend.py --capture
+# trace.gz) against a cluster, and compare how it went with the capture:
+#
+#   $ python tools/replay.py trace.gz [--speed 1 | N | max] [--json file]
+#
+# each captured session replays in order on its own connection to a
+# frontend. --speed N sends every operation N times sooner after the
+# start than it was captured (and its latency counts from when it was
+# due, so that queueing shows), max sends each session's operations back
+# to back. movies created by add_movie get new ids, which later
+# operations on them use instead once we know them.
+#
+# consistency: every get_user_data which reads its own session's writes
+# (for ratings and tags no other session writes) has to reflect them.
+
+WRITES = ("add_rating", "delete_rating", "add_tag", "remove_tag")
+MOVIE_ARG = {"get_movie": 0, "add_rating": 1, "delete_rating": 1, "add_tag": 1, "remove_tag": 1}
+
+
+def read_trace(path):
+    # => [(start, session, operation, args, kwargs, seconds, ok, movie id)],
+    # without the record the frontend was writing if it was killed
+    records = []
+    with gzip.open(path, "rb") as f:
+        while True:
+            try:
+                records.append(marshal.load(f))
+            except (EOFError, ValueError, TypeError, zlib.error, gzip.BadGzipFile):
+                break
+    records.sort(key=lambda record: record[0])
+    return records
+
+
+def exclusive_keys(records):
+    # => the rating keys (user, movie) and tag keys (user, movie, tag)
+    # only one session writes
+    writers = defaultdict(set)
+    for _, session, name, args, _, _, _, _ in records:
+        for key in write_keys(name, args):
+            writers[key].add(session)
+    return {key for key, sessions in writers.items() if len(sessions) == 1}
+
+
+def write_keys(name, args):
+    # => {key: value it now has} for an update
+    if name == "add_rating":
+        return {args[:2]: args[2]}
+    if name == "delete_rating":
+        return {args[:2]: None}
+    if name in ("add_tag", "remove_tag"):
+        return {args[:2] + (tag,): name == "add_tag" for tag in args[2]}
+    return {}
+
+
+def violations(data, user_id, expected):
+    # => the keys of user_id whose value in data isn't the one we expect
+    wrong = []
+    for key, value in expected.items():
+        if key[0] != user_id:
+            continue
+        if len(key) == 2:
+            found = data["ratings"].get(key[1])
+        else:
+            found = key[2] in data["tags"].get(key[1], ())
+        if found != value:
+            wrong.append(key)
+    return wrong
+
+
+class Replay:
+    def __init__(self, records, speed=1.0):
+        self.records = records
+        self.speed = speed  # None => as fast as possible
+        self.exclusive = exclusive_keys(records)
+        self.movies = {}  # captured movie id => replayed one
+        self.lock = threading.Lock()
+        self.latency = defaultdict(lambda: Histogram(LATENCY))
+        self.captured = defaultdict(lambda: Histogram(LATENCY))
+        self.errors = Counter()
+        self.captured_errors = Counter()
+        self.checks = 0
+        self.inconsistent = []
+        self.start = None
+        for _, _, name, _, _, seconds, ok, _ in records:
+            if ok:
+                self.captured[name].observe(seconds)
+            else:
+                self.captured_errors[name] += 1
+
+    def movie(self, movie_id):
+        with self.lock:
+            return self.movies.get(movie_id, movie_id)
+
+    def session(self, frontend, records):
+        expected = {}
+        for start, _, name, args, kwargs, _, _, created in records:
+            if name in MOVIE_ARG:
+                i = MOVIE_ARG[name]
+                args = args[:i] + (self.movie(args[i]),) + args[i + 1:]
+            due = perf_counter()
+            if self.speed is not None:
+                due = self.start + (start - self.records[0][0]) / self.speed
+                sleep(max(0, due - perf_counter()))
+            try:
+                result = getattr(frontend, name)(*args, **kwargs)
+                error = False
+            except (RuntimeError, CommunicationError):
+                error = True
+            seconds = perf_counter() - due
+            wrong = None
+            if not error:
+                if name in WRITES:
+                    expected.update((key, value) for key, value in write_keys(name, args).items()
+                                    if key in self.exclusive)
+                elif name == "forget":
+                    expected = {}
+                elif name == "add_movie" and created is not None:
+                    with self.lock:
+                        self.movies[created] = result
+                elif name == "get_user_data" and kwargs.get("consistency", "causal") == "causal":
+                    wrong = violations(result, args[0], expected)
+            with self.lock:
+                if error:
+                    self.errors[name] += 1
+                else:
+                    self.latency[name].observe(seconds)
+                if wrong is not None:
+                    self.checks += 1
+                    self.inconsistent.extend(wrong)
+
+    def run(self):
+        # => seconds it took
+        sessions = defaultdict(list)
+        for record in self.records:
+            sessions[record[1]].append(record)
+        threads = [threading.Thread(target=self.session, args=(connect_frontend(), records))
+                   for records in sessions.values()]
+        self.start = perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return perf_counter() - self.start
+
+    def report(self, seconds):
+        # => {"seconds", "captured_seconds", "sessions", "operations":
+        # {operation: {"count", "errors", "p50", "p99"} for the capture and
+        # the replay}, "consistency": {"checks", "violations"}}
+        operations = {}
+        for name in sorted(set(self.captured) | set(self.captured_errors)):
+            operations[name] = {}
+            for run, latency, errors in (("captured", self.captured, self.captured_errors),
+                                         ("replayed", self.latency, self.errors)):
+                h = latency[name]
+                operations[name][run] = {"count": h.count, "errors": errors[name],
+                                         "p50": h.quantile(0.5), "p99": h.quantile(0.99)}
+        return {"seconds": seconds,
+                "captured_seconds": self.records[-1][0] - self.records[0][0],
+                "sessions": len({record[1] for record in self.records}),
+                "operations": operations,
+                "consistency": {"checks": self.checks,
+                                "violations": [list(key) for key in self.inconsistent]}}
+
+
+def print_report(results):
+    def ms(seconds):
+        return "%8s" % ("-" if seconds is None else "%.1f" % (seconds * 1000))
+
+    print("%-14s %7s %7s %8s %8s   %7s %7s %8s %8s" % (
+        "operation", "count", "errors", "p50", "p99", "count", "errors", "p50", "p99"))
+    print("%-14s %-33s   %s" % ("", "captured", "replayed"))
+    for name, runs in results["operations"].items():
+        captured, replayed = runs["captured"], runs["replayed"]
+        print("%-14s %7d %7d %s %s   %7d %7d %s %s" % (
+            name, captured["count"], captured["errors"], ms(captured["p50"]), ms(captured["p99"]),
+            replayed["count"], replayed["errors"], ms(replayed["p50"]), ms(replayed["p99"])))
+    consistency = results["consistency"]
+    print("%d sessions, captured over %.1fs, replayed in %.1fs, latencies in ms" % (
+        results["sessions"], results["captured_seconds"], results["seconds"]))
+    print("read your writes: %d reads checked, %d stale keys" % (
+        consistency["checks"], len(consistency["violations"])))
+    for key in consistency["violations"][:10]:
+        print("  %s" % (key,))
+
+
+def main(args):
+    if not args or args[0].startswith("--"):
+        sys.exit("usage: replay.py trace.gz [--speed 1 | N | max] [--json file]")
+    options = {"speed": "1", "json": None}
+    path, args = args[0], args[1:]
+    for name, value in zip(args[::2], args[1::2]):
+        if not name.startswith("--") or name[2:] not in options:
+            sys.exit("unknown option %s" % name)
+        options[name[2:]] = value
+    records = read_trace(path)
+    if not records:
+        sys.exit("no operations in %s" % path)
+    replay = Replay(records, None if options["speed"] == "max" else float(options["speed"]))
+    results = replay.report(replay.run())
+    print_report(results)
+    if options["json"]:
+        with open(options["json"], "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    serializer.configure()
+    main(sys.argv[1:])
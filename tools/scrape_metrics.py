@@ -0,0 +1,50 @@
+import sys
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from os.path import dirname, join
+sys.path.insert(0, join(dirname(__file__), ".."))
+
+import Pyro4
+from Pyro4.errors import CommunicationError
+
+import serializer
+from metrics import prometheus
+
+# print the replicas' metrics in the Prometheus text format, or serve
+# them for a Prometheus server to scrape:
+#
+#   $ python tools/scrape_metrics.py [replica id]
+#   $ python tools/scrape_metrics.py --serve [port]
+
+
+def scrape(id=None):
+    with Pyro4.locateNS() as ns:
+        if id is None:
+            uris = ns.list(metadata_all={"replica"}).values()
+        else:
+            uris = [ns.lookup("replica:%s" % id)]
+    sources = []
+    for uri in uris:
+        try:
+            with Pyro4.Proxy(uri) as replica:
+                sources.append(({"replica": Pyro4.URI(uri).object}, replica.metrics()))
+        except CommunicationError:
+            pass
+    return prometheus(sources, "rated_replica_")
+
+
+class Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = scrape().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+serializer.configure()
+if len(sys.argv) > 1 and sys.argv[1] == "--serve":
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else 9100
+    HTTPServer(("", port), Handler).serve_forever()
+else:
+    sys.stdout.write(scrape(sys.argv[1] if len(sys.argv) > 1 else None))
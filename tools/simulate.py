@@ -0,0 +1,369 @@
+import heapq
+import json
+import marshal
+import os
+import random
+import sys
+from itertools import count
+from os.path import dirname, join
+from time import perf_counter
+
+# set iteration orders have to be the same from run to run
+if os.environ.get("PYTHONHASHSEED") != "0":
+    os.execve(sys.executable, [sys.executable] + sys.argv, dict(os.environ, PYTHONHASHSEED="0"))
+
+sys.path.insert(0, join(dirname(__file__), ".."))
+
+import vector_clock as vc
+from models import AddTag, DB, Update
+from replica import Replica
+
+# a discrete event simulation of a cluster: Replica objects in one process,
+# on virtual time, gossiping over a simulated network with latency, loss
+# and partitions, while clients send them updates. each replica runs the
+# steps of Replica.gossip() (housekeeping, which takes replicas offline at
+# random, gossip rounds with the adaptive period and fanout, digests for
+# large differences) and reports how long the cluster takes to converge
+# once the clients stop, and how much gossip that took:
+#
+#   $ python tools/simulate.py [--replicas 5,10,25,50] [--updates 500]
+#         [--rate 100] [--sessions 10] [--latency 0.005] [--jitter 0.005]
+#         [--loss 0] [--partition start:end] [--no-offline] [--seed 0]
+#         [--json results.json]
+#
+# runs are deterministic for a seed. what isn't simulated: the CPU time
+# replicas take (rebuilds and applies are instantaneous in virtual time),
+# reads and their pulls, state transfer, and the name server, which every
+# replica knows about from the start. peers of a round are gossiped to at
+# the same time, like the aio replica does.
+
+
+class Network:
+    # an RPC takes latency + up to jitter seconds each way. messages are
+    # lost with probability loss, or when the two ends are on different
+    # sides of the partition; the caller finds out after timeout seconds.
+    def __init__(self, sim, latency, jitter, loss, timeout=1):
+        self.sim = sim
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.timeout = timeout
+        self.side = None  # ids on one side of the partition, None => none
+
+    def delay(self):
+        return self.latency + self.sim.random.random() * self.jitter
+
+    def dropped(self, src, dst):
+        if self.sim.random.random() < self.loss:
+            return True
+        # clients reach both sides
+        return self.side is not None and "client" not in (src, dst) \
+            and (src in self.side) != (dst in self.side)
+
+    def call(self, src, dst, request, reply, failed):
+        # request() runs on dst, then reply(result) on src. failed() runs
+        # on src instead when a message is dropped, or when request()
+        # raises a RuntimeError (offline replica)
+        start = self.sim.now
+
+        def timed_out():
+            self.sim.at(start + self.timeout, failed)
+
+        def arrive():
+            try:
+                result = request()
+            except RuntimeError:
+                self.sim.after(self.delay(), failed)
+                return
+            if self.dropped(dst, src):
+                timed_out()
+            else:
+                self.sim.after(self.delay(), lambda: reply(result))
+
+        if self.dropped(src, dst):
+            timed_out()
+        else:
+            self.sim.after(self.delay(), arrive)
+
+
+class Simulation:
+    def __init__(self, n, seed=0, latency=0.005, jitter=0.005, loss=0, offline=True):
+        self.now = 0.0
+        self.queue = []  # (time, seq, f)
+        self.seq = count()
+        # replicas and their views draw from the global random
+        random.seed(seed)
+        self.random = random.Random(seed)
+        self.network = Network(self, latency, jitter, loss)
+        self.replicas = {}
+        self.loops = {}  # id => state of its gossip loop
+        for i in range(n):
+            self.add_replica("r%03d" % i, offline)
+        self.uris = {id: r.membership.uri for id, r in self.replicas.items()}
+        self.data = DB.from_data()
+        self.updates = self.acknowledged = 0
+        self.ts = {}  # of all the updates acknowledged
+        self.last_update = None
+        self.converged = None
+        self.buffer_max = 0
+        self.exchanges = 0
+        self.idle_first_rounds = 0  # first gossip rounds with no peer picked
+
+    def add_replica(self, id, offline):
+        r = Replica(id)
+        r.clock = r.membership.clock = lambda: self.now
+        r.last_change = r.last_status = self.now
+        r.membership.uri = "PYRO:%s@simulated:0" % id
+        r.workers = 1  # no process pool
+        r.bootstrapping = False
+        if not offline:
+            r.status_period = float("inf")
+        self.replicas[id] = r
+        self.loops[id] = {"last_ns": None, "wake": None, "earliest": 0, "rounds": 0}
+
+    # event queue
+
+    def at(self, t, f):
+        heapq.heappush(self.queue, (t, next(self.seq), f))
+
+    def after(self, delay, f):
+        self.at(self.now + delay, f)
+
+    def run(self, until):
+        while self.queue and self.queue[0][0] <= until:
+            self.now, _, f = heapq.heappop(self.queue)
+            f()
+        self.now = until
+
+    # the gossip loop of Replica.gossip(), one step at a time
+
+    def start(self):
+        for id in self.replicas:
+            # don't all start at the same time
+            self.after(self.random.random() * 0.1, lambda id=id: self.top(id))
+
+    def top(self, id):
+        r, loop = self.replicas[id], self.loops[id]
+        if loop["last_ns"] is None or self.now - loop["last_ns"] >= r.ns_period:
+            r.membership.reconcile(self.uris)
+            loop["last_ns"] = self.now
+        if r.housekeeping(self.now):
+            r.reconstruct()
+            r.last_change = self.now
+        self.check_converged()
+        # wait for the period to end, or for a local update
+        loop["earliest"] = self.now + r.min_sync_period
+        self.wake_at(id, self.now + r.sync_period)
+
+    def wake_at(self, id, t):
+        loop = self.loops[id]
+        loop["wake"] = t
+        self.at(t, lambda: self.wake(id, t))
+
+    def local_update(self, id):
+        loop = self.loops[id]
+        if loop["wake"] is not None and loop["wake"] > max(loop["earliest"], self.now):
+            self.wake_at(id, max(loop["earliest"], self.now))
+
+    def wake(self, id, t):
+        r, loop = self.replicas[id], self.loops[id]
+        if loop["wake"] != t:
+            # woken earlier by an update
+            return
+        loop["wake"] = None
+        if not r.is_online or r.forced_offline:
+            self.top(id)
+            return
+        r.membership.beat()
+        peers = r.membership.select(r.fanout)
+        if not loop["rounds"] and not peers:
+            # every replica knows the others from the start
+            self.idle_first_rounds += 1
+        loop["rounds"] += 1
+        results = []
+
+        def done(peer, result):
+            r.membership.report(peer, result is not None)
+            results.append(result)
+            if len(results) == len(peers):
+                r.adapt(sum(bool(result) for result in results))
+                self.top(id)
+
+        if not peers:
+            r.adapt(0)
+            self.top(id)
+        for peer, _ in peers:
+            self.exchange(r, self.replicas[peer], lambda result, peer=peer: done(peer, result))
+
+    def exchange(self, a, b, done):
+        # Replica.gossip_to(), with done(whether we sent updates, None if
+        # the peer couldn't be reached) instead of returning
+        uri = self.uris[b.id]
+        failed = lambda: done(None)
+        self.exchanges += 1
+
+        def send(ts, events):
+            if not events:
+                a.count_gossip(uri, events)
+                done(False)
+                return
+            # as if marshalled by the RPC
+            payload = marshal.dumps(events)
+            a.count_gossip(uri, events, len(payload))
+            events = marshal.loads(payload)
+            self.network.call(a.id, b.id, lambda: self.sync(b, events, ts),
+                              lambda _: done(True), failed)
+
+        def differing(ts, theirs):
+            origins = a.differing_origins(theirs)
+            if not origins:
+                send(ts, [])
+                return
+            self.network.call(a.id, b.id, lambda: b.get_digests(origins),
+                              lambda buckets: send(ts, a.differing_events(origins, buckets)),
+                              failed)
+
+        def exchanged(result):
+            t, view = result
+            a.membership.merge(view)
+            ts, events = a.events_for(uri, t)
+            if len(events) > a.digest_threshold:
+                self.network.call(a.id, b.id, b.get_digests,
+                                  lambda theirs: differing(ts, theirs), failed)
+            else:
+                send(ts, events)
+
+        view = a.membership.export()
+        self.network.call(a.id, b.id, lambda: b.exchange_views(view), exchanged, failed)
+
+    def sync(self, r, events, ts):
+        unsent = r.unsent
+        r.sync(events, ts)
+        if r.unsent > unsent:
+            # like Replica.wake_gossip()
+            self.local_update(r.id)
+        self.buffer_max = max(self.buffer_max, len(r.buffer))
+
+    # clients
+
+    def load(self, updates, rate, sessions):
+        # sessions send updates at rate per second in total, each one to a
+        # random replica, trying another one while it's offline
+        users, movies = sorted(self.data.ratings), sorted(self.data.movies)
+        ids = sorted(self.replicas)
+        clocks = [{} for _ in range(sessions)]
+        self.updates = updates
+
+        def send(n, session, op, attempt=0):
+            # a retry is a new update: the replica may have applied the
+            # one whose acknowledgement got lost
+            r = self.replicas[self.random.choice(ids)]
+
+            def acknowledged(ts):
+                clocks[session] = vc.merge(clocks[session], ts)
+                self.ts = vc.merge(self.ts, ts)
+                self.acknowledged += 1
+                self.last_update = self.now
+                self.local_update(r.id)
+
+            self.network.call("client", r.id,
+                              lambda: r.update(op.to_raw(), clocks[session], "u%d.%d" % (n, attempt)),
+                              acknowledged, lambda: self.after(0.05, lambda: send(n, session, op, attempt + 1)))
+
+        t = 0
+        for n in range(updates):
+            t += self.random.expovariate(rate)
+            op = Update(self.random.choice(users), self.random.choice(movies), 4.5)
+            if self.random.random() < 0.2:
+                op = AddTag(self.random.choice(users), self.random.choice(movies), ["simulated"])
+            self.at(t, lambda n=n, op=op: send(n, n % sessions, op))
+
+    def check_converged(self):
+        # converged => every update was acknowledged, and the replicas
+        # applied the same ones, which include those (retries whose
+        # acknowledgement was lost make for more than were acknowledged)
+        replicas = list(self.replicas.values())
+        if self.converged is None and self.acknowledged == self.updates \
+                and vc.geq(replicas[0].ts, self.ts) \
+                and all(r.ts == replicas[0].ts and not r.buffer for r in replicas):
+            self.converged = self.now
+
+    def same_state(self):
+        def state(r):
+            return ([(user, sorted(ratings.items())) for user, ratings in sorted(r.db.ratings.items()) if ratings],
+                    [(user, sorted((movie, sorted(tags)) for movie, tags in data.items() if tags))
+                     for user, data in sorted(r.db.tags.items())])
+        states = [state(r) for r in self.replicas.values()]
+        return all(s == states[0] for s in states)
+
+
+def simulate(n, updates=500, rate=100, sessions=10, seed=0, latency=0.005,
+             jitter=0.005, loss=0, partition=None, offline=True, max_time=600):
+    sim = Simulation(n, seed, latency, jitter, loss, offline)
+    sim.start()
+    sim.load(updates, rate, sessions)
+    if partition is not None:
+        begin, end = partition
+        side = set(sorted(sim.replicas)[:n // 2])
+        sim.at(begin, lambda: setattr(sim.network, "side", side))
+        sim.at(end, lambda: setattr(sim.network, "side", None))
+    start = perf_counter()
+    while sim.converged is None and sim.now < max_time:
+        sim.run(sim.now + 1)
+    # give the replicas time to rebuild their states in the same order
+    any_replica = next(iter(sim.replicas.values()))
+    sim.run(sim.now + any_replica.reconstruct_period + 2 * any_replica.max_sync_period)
+    sent = [stats for r in sim.replicas.values() for stats in r.gossip_sent.values()]
+    return {
+        "replicas": n,
+        "updates": sim.acknowledged,
+        "converged": None if sim.converged is None else sim.converged - sim.last_update,
+        "exchanges": sim.exchanges,
+        "entries_sent": sum(stats["entries_total"] for stats in sent),
+        "bytes_sent": sum(stats["bytes_total"] for stats in sent),
+        "buffer_max": sim.buffer_max,
+        "same_state": sim.same_state(),
+        "idle_first_rounds": sim.idle_first_rounds,
+        "wall_seconds": perf_counter() - start,
+    }
+
+
+def main(args):
+    options = {"replicas": "5,10,25,50", "updates": "500", "rate": "100", "sessions": "10",
+               "latency": "0.005", "jitter": "0.005", "loss": "0", "seed": "0",
+               "partition": None, "json": None}
+    offline = "--no-offline" not in args
+    args = [arg for arg in args if arg != "--no-offline"]
+    for name, value in zip(args[::2], args[1::2]):
+        if not name.startswith("--") or name[2:] not in options:
+            sys.exit("unknown option %s" % name)
+        options[name[2:]] = value
+    partition = None
+    if options["partition"] is not None:
+        partition = tuple(map(float, options["partition"].split(":")))
+    print("%8s %8s %10s %10s %10s %12s %8s %6s %8s" % (
+        "replicas", "updates", "converged", "exchanges", "entries", "bytes", "buffer", "same", "wall"))
+    results = []
+    for n in map(int, options["replicas"].split(",")):
+        result = simulate(n, int(options["updates"]), float(options["rate"]),
+                          int(options["sessions"]), int(options["seed"]),
+                          float(options["latency"]), float(options["jitter"]),
+                          float(options["loss"]), partition, offline)
+        results.append(result)
+        converged = "never" if result["converged"] is None else "%.2fs" % result["converged"]
+        print("%8d %8d %10s %10d %10d %12d %8d %6s %7.1fs" % (
+            n, result["updates"], converged, result["exchanges"], result["entries_sent"],
+            result["bytes_sent"], result["buffer_max"], result["same_state"], result["wall_seconds"]))
+    if options["json"]:
+        with open(options["json"], "w") as f:
+            json.dump(results, f, indent=2)
+    idle = sum(result["idle_first_rounds"] for result in results)
+    if idle:
+        # the convergence times above include the wait
+        print("\033[31mFAIL\033[0m")
+        print("%d replicas didn't gossip on their first round" % idle)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,19 +1,28 @@
 from base64 import b64encode
+from concurrent.futures import BrokenExecutor
 from contextlib import contextmanager
-from random import shuffle
+from functools import wraps
+from inspect import iscoroutinefunction
 from operator import attrgetter
+from threading import Lock
+from time import perf_counter
 from uuid import uuid4
 import os
 import signal
 
 import Pyro4
 from Pyro4.errors import ConnectionClosedError, CommunicationError, TimeoutError
+from collections import defaultdict
+from metrics import Histogram, add, start_trace, stage
+from models import DB
 import vector_clock as vc
 
 
-def unregister_at_exit(name):
+def unregister_at_exit(name, cleanup=None):
     def u():
         Pyro4.locateNS().remove(name)
+        if cleanup is not None:
+            cleanup()
         os._exit(0)
     signal.signal(signal.SIGTERM, lambda *_: u())
     signal.signal(signal.SIGINT,  lambda *_: u())
@@ -23,13 +32,6 @@ def generate_id(l=10):
     return b64encode(uuid4().bytes, altchars=b"+-").decode()[:-2][:l]
 
 
-def find_random_peers(ns, id, metadata):
-    peers = ns.list(metadata_all={metadata})
-    choices = [uri for name, uri in peers.items() if id not in name]
-    shuffle(choices)
-    return choices
-
-
 @contextmanager
 def ignore_disconnects():
     try:
@@ -48,11 +50,185 @@ def ignore_status_errors():
         raise
 
 
+class TimedLock:
+    # a Lock which keeps a moving average of how long it takes to acquire,
+    # and histograms of the waits and of how long it is held
+    def __init__(self, alpha=0.1):
+        self.lock = Lock()
+        self.alpha = alpha
+        self.wait = 0.0
+        self.waits = Histogram()
+        self.holds = Histogram()
+        self.acquired = 0
+
+    def acquire(self, blocking=True, timeout=-1):
+        start = perf_counter()
+        acquired = self.lock.acquire(blocking, timeout)
+        if acquired:
+            now = self.acquired = perf_counter()
+            self.wait += self.alpha * (now - start - self.wait)
+            self.waits.observe(now - start)
+            add("lock_wait", now - start)
+        return acquired
+
+    def release(self):
+        self.holds.observe(perf_counter() - self.acquired)
+        self.lock.release()
+
+    # for threading.Condition, which would otherwise check whether we
+    # hold the lock by acquiring it without blocking, and count a wait
+
+    def _is_owned(self):
+        if self.lock.acquire(False):
+            self.lock.release()
+            return False
+        return True
+
+    def _release_save(self):
+        self.release()
+
+    def _acquire_restore(self, state):
+        self.acquire()
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class ByteCounter:
+    # stands in for a Pyro4 proxy's connection, counting the bytes of the
+    # messages sent over it:
+    #
+    #   counter = proxy._pyroConnection = ByteCounter(proxy._pyroConnection)
+    def __init__(self, connection):
+        self.connection = connection
+        self.sent = 0
+
+    def send(self, data):
+        self.sent += len(data)
+        self.connection.send(data)
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+
+def count_requests(cls):
+    # class decorator: instances of cls keep the number of calls to their
+    # exposed methods that are in progress in self.requests, and time
+    # each call as a stage of its trace (see metrics.trace)
+    def counted(method):
+        if iscoroutinefunction(method):
+            @wraps(method)
+            async def coroutine(self, *args, **kwargs):
+                with self.requests_lock:
+                    self.requests += 1
+                start_trace()
+                try:
+                    with stage(method.__name__):
+                        return await method(self, *args, **kwargs)
+                finally:
+                    with self.requests_lock:
+                        self.requests -= 1
+            return coroutine
+
+        @wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.requests_lock:
+                self.requests += 1
+            start_trace()
+            try:
+                with stage(method.__name__):
+                    return method(self, *args, **kwargs)
+            finally:
+                with self.requests_lock:
+                    self.requests -= 1
+        return wrapper
+
+    for name, method in list(vars(cls).items()):
+        if getattr(method, "_pyroExposed", False):
+            setattr(cls, name, counted(method))
+    return cls
+
+
 def sort_buffer(buffer):
     buffer.sort(key=attrgetter("time", "id"))
 
 
-def apply_updates(ts, db, executed_ids, executed_uids, log, buffer):
+class Recorder:
+    # stands in for a DB: remembers the updates applied to it, in order
+    def __init__(self):
+        self.entries = []
+
+    def apply(self, e):
+        self.entries.append(e)
+
+    def apply_copy(self, e):
+        pass
+
+
+def replay_partition(ratings, tags, ops):
+    # runs in a worker process: apply ops to the given users' data
+    db = DB()
+    for user_id, data in ratings.items():
+        db.ratings[user_id].update(data)
+    for user_id, data in tags.items():
+        for movie_id, movie_tags in data.items():
+            db.tags[user_id][movie_id].update(movie_tags)
+    for op in ops:
+        op.apply(db)
+    return ({user_id: dict(data) for user_id, data in db.ratings.items()},
+            {user_id: {movie_id: set(movie_tags) for movie_id, movie_tags in data.items()}
+             for user_id, data in db.tags.items()})
+
+
+def replay(db, entries, pool, partitions):
+    # apply the updates of entries to db, in order. updates to ratings and
+    # tags only touch the data of their user and movie updates only touch
+    # the catalog, so we split them by user across the processes of pool.
+    # db is only changed once every partition is done, so it is left as
+    # it was if the pool fails.
+    ops = [[] for _ in range(partitions)]
+    catalog = []
+    for e in entries:
+        user_id = getattr(e.op, "user_id", None)
+        if user_id is None:
+            catalog.append(e.op)
+        else:
+            ops[hash(user_id) % partitions].append(e.op)
+    jobs = []
+    for part in ops:
+        users = {op.user_id for op in part}
+        ratings = {u: dict(db.ratings[u]) for u in users if u in db.ratings}
+        tags = {u: {m: set(t) for m, t in db.tags[u].items()}
+                for u in users if u in db.tags}
+        jobs.append(pool.submit(replay_partition, ratings, tags, part))
+    results = [job.result() for job in jobs]
+    for op in catalog:
+        op.apply(db)
+    for ratings, tags in results:
+        for user_id, data in ratings.items():
+            db.ratings[user_id] = defaultdict(int, data)
+        for user_id, data in tags.items():
+            db.tags[user_id] = defaultdict(set, data)
+
+
+def apply_updates(ts, db, executed_ids, executed_uids, log, buffer,
+                  pool=None, partitions=1):
+    # pool => work out which updates to apply first, then replay them
+    # on the process pool, or here if the pool is broken (a worker was
+    # killed), since they're already in the log
+    if pool is not None:
+        recorder = Recorder()
+        ts, buffer = apply_updates(ts, recorder, executed_ids,
+                                   executed_uids, log, buffer)
+        try:
+            replay(db, recorder.entries, pool, partitions)
+        except BrokenExecutor:
+            for e in recorder.entries:
+                db.apply(e)
+        return ts, buffer
     has_event = True
     while has_event:
         has_event = False
@@ -63,15 +239,19 @@ def apply_updates(ts, db, executed_ids, executed_uids, log, buffer):
                 if (e.id, e.node_id) not in executed_uids:
                     # we've seen our copy (or some copy) of
                     # this update before, so just pretend we've
-                    # executed it and put it in the log
+                    # executed it and put it in the log.
+                    # the updates depending on it may be
+                    # earlier in the buffer, so go round again
+                    has_event = True
+                    db.apply_copy(e)
                     ts = vc.merge(ts, e.ts)
                     log.append(e)
                     executed_uids.add((e.id, e.node_id))
                 continue
             # if we can apply this update
-            if vc.geq(ts, e.prev):
+            if vc.geq(ts, e.prev) and executed_ids.issuperset(e.deps):
                 has_event = True
-                e.op.apply(db)
+                db.apply(e)
                 ts = vc.merge(ts, e.ts)
                 executed_ids.add(e.id)
                 executed_uids.add((e.id, e.node_id))
@@ -30,6 +30,11 @@ def geq(v1, v2):
     return equal(v1, v2) or compare(v1, v2) == 1
 
 
+def missing(v1, v2):
+    # number of updates in v2 that are not in v1
+    return sum(max(0, value - v1.get(key, 0)) for key, value in v2.items())
+
+
 def merge(v1, v2):
     v3 = v1.copy()
     for key, value in v2.items():